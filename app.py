@@ -29,22 +29,32 @@ dev_stack = PipelineStack(
     git_repo='your-gitcommit-repo', git_branch='master',
     service_stacks=['app-dev'],
     sns_emails=['your.name@example.com'],
+    # Hand each green build straight on to staging
+    promote_to='staging',
+    approve_promotion=False,
 )
 
+# Staging and prod deploy the releases promoted to them rather than
+# building their own. Releases only go on from staging to prod once
+# someone has approved them in the staging pipeline. Replace the promotion arguments with git_repo and
+# git_branch to have them build their branches instead.
 PipelineStack(
     app, 'pipeline-staging', env=env, tags=tags,
     project_name='YourApp', stage='staging',
-    git_repo='your-gitcommit-repo', git_branch='staging',
     service_stacks=['app-staging'],
     sns_emails=None,
+    promoted=True,
+    promote_to='prod',
+    release_bucket=dev_stack.release_bucket,
 )
 
 PipelineStack(
     app, 'pipeline-prod', env=env, tags=tags,
     project_name='YourApp', stage='prod',
-    git_repo='your-gitcommit-repo', git_branch='prod',
     service_stacks=['app-prod'],
     sns_emails=['some.other.name@example.com'],
+    promoted=True,
+    release_bucket=dev_stack.release_bucket,
 )
 
 app.synth()
@@ -37,6 +37,7 @@ setuptools.setup(
         "pytest",
         "pylint",
         "coverage",
+        "pyyaml",
         "wheel",
         "aws_xray_sdk",
     ],
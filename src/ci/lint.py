@@ -0,0 +1,337 @@
+import os
+import ast
+import sys
+import json
+import hashlib
+import argparse
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+
+RCFILE = 'pylintrc'
+CACHE_DIR = os.path.join('.pylint.d', 'files')
+SCORE_FILE = os.path.join('.pylint.d', 'score.json')
+
+# Where the project's own modules are imported from
+SOURCE_ROOTS = ['.', 'src']
+
+# Used when the rcfile doesn't say how to compute the score
+DEFAULT_EVALUATION = \
+    '10.0 - ((float(5 * error + warning + refactor + convention) / statement) * 10)'
+
+# The counters we need from pylint in order to recompute the global score
+STAT_NAMES = ['statement', 'fatal', 'error', 'warning', 'refactor', 'convention']
+
+# Pylint's bit-encoded exit status
+EXIT_BITS = {'fatal': 1, 'error': 2, 'warning': 4, 'refactor': 8, 'convention': 16}
+
+
+# -----------------------------------------------------------
+# Configuration
+# -----------------------------------------------------------
+
+def read_rcfile(rcfile):
+    config = configparser.ConfigParser(interpolation=None, strict=False)
+    config.read(rcfile)
+    return config
+
+
+def ignored_names(config):
+    names = config.get('MASTER', 'ignore', fallback='CVS')
+    return {name.strip() for name in names.split(',') if name.strip()}
+
+
+def evaluation(config):
+    return config.get('REPORTS', 'evaluation', fallback=DEFAULT_EVALUATION)
+
+
+def find_python_files(root, ignore):
+    # Walk the tree like pylint's own 'ignore' setting would, also
+    # skipping hidden directories such as .git and .pylint.d
+    result = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if d not in ignore and not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.endswith('.py') and filename not in ignore:
+                path = os.path.relpath(os.path.join(dirpath, filename), root)
+                result.append(path)
+    return result
+
+
+# -----------------------------------------------------------
+# The per-file cache
+# -----------------------------------------------------------
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        digest.update(file.read())
+    return digest.hexdigest()
+
+
+def pylint_version():
+    try:
+        from pylint import __version__
+    except ImportError:
+        return 'unknown'
+    return __version__
+
+
+def imported_names(path):
+    # The modules a file imports, with relative imports made absolute
+    # as far as the file's place in the tree allows
+    try:
+        with open(path, 'rb') as file:
+            tree = ast.parse(file.read(), path)
+    except (SyntaxError, ValueError):
+        return []
+    package = os.path.dirname(path).replace(os.sep, '.')
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                parts = package.split('.') if package else []
+                parts = parts[:len(parts) - node.level + 1]
+                base = '.'.join(p for p in parts + [base] if p)
+            names.append(base)
+            # From-imports may name submodules as well as attributes
+            names += [f'{base}.{alias.name}' if base else alias.name
+                      for alias in node.names]
+    return [name for name in names if name]
+
+
+def module_path(name, roots):
+    relative = name.replace('.', os.sep)
+    for root in roots:
+        for candidate in [f'{relative}.py', os.path.join(relative, '__init__.py')]:
+            path = os.path.normpath(os.path.join(root, candidate))
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def project_imports(path, roots=None):
+    # All the project files a file depends on through its imports, directly
+    # or not. Messages such as no-member or import-error depend on them.
+    roots = [os.path.dirname(path) or '.'] + (SOURCE_ROOTS if roots is None else roots)
+    found = set()
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        for name in imported_names(current):
+            dependency = module_path(name, roots)
+            if dependency and dependency not in found and dependency != path:
+                found.add(dependency)
+                pending.append(dependency)
+    return sorted(found)
+
+
+def cache_key(path, rc_hash, version, roots=None):
+    # The path is part of the key since it shows up in the messages
+    key = f'{version}\0{rc_hash}\0{path}\0{hash_file(path)}'
+    for dependency in project_imports(path, roots):
+        key += f'\0{dependency}\0{hash_file(dependency)}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def load_cached(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, f'{key}.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached(cache_dir, key, result):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, f'{key}.json'), 'w') as file:
+        json.dump(result, file)
+
+
+def prune_cache(cache_dir, keep):
+    # Drop the entries for files which no longer exist in this form
+    if not os.path.isdir(cache_dir):
+        return
+    for filename in os.listdir(cache_dir):
+        if filename.endswith('.json') and filename[:-5] not in keep:
+            os.remove(os.path.join(cache_dir, filename))
+
+
+# -----------------------------------------------------------
+# Linting
+# -----------------------------------------------------------
+
+def get_stat(stats, name):
+    # Pylint < 2.12 keeps its stats in a dict, later versions in an object
+    if isinstance(stats, dict):
+        return stats.get(name, 0)
+    return getattr(stats, name, 0)
+
+
+def lint_file(path, rcfile):
+    # Runs in a worker process. The reports and the persistent stats are
+    # turned off since we build the summary ourselves, and each worker
+    # lints a single file so pylint mustn't spawn any more processes.
+    from pylint.lint import Run
+    from pylint.reporters import CollectingReporter
+
+    reporter = CollectingReporter()
+    run = Run([f'--rcfile={rcfile}', '--jobs=1', '--persistent=n',
+               '--reports=n', '--score=n', path],
+              reporter=reporter, exit=False)
+    stats = run.linter.stats
+    return {
+        'path': path,
+        'messages': [
+            {
+                'module': msg.module,
+                'path': msg.path,
+                'line': msg.line,
+                'column': msg.column,
+                'msg_id': msg.msg_id,
+                'symbol': msg.symbol,
+                'msg': msg.msg,
+            }
+            for msg in reporter.messages
+        ],
+        'stats': {name: get_stat(stats, name) for name in STAT_NAMES},
+    }
+
+
+def lint_files(paths, rcfile, jobs=None):
+    if not paths:
+        return []
+    if jobs == 1 or len(paths) == 1:
+        return [lint_file(path, rcfile) for path in paths]
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        return list(executor.map(lint_file, paths, [rcfile] * len(paths)))
+
+
+# -----------------------------------------------------------
+# The combined output
+# -----------------------------------------------------------
+
+def total_stats(results):
+    totals = dict.fromkeys(STAT_NAMES, 0)
+    for result in results:
+        for name in STAT_NAMES:
+            totals[name] += result['stats'].get(name, 0)
+    return totals
+
+
+def score(totals, expression=DEFAULT_EVALUATION):
+    if not totals['statement']:
+        return None
+    # Same as pylint: the rcfile's expression, evaluated over the counters
+    # as it stands, so it may well come out negative
+    return eval(expression, {}, dict(totals))   # pylint: disable=eval-used
+
+
+def exit_status(totals):
+    status = 0
+    for name, bit in EXIT_BITS.items():
+        if totals[name]:
+            status |= bit
+    return status
+
+
+def format_report(results, note, previous=None):
+    result = ''
+    # Problems with the rcfile itself are reported once per linted file
+    seen = set()
+    for file_result in results:
+        module = None
+        for msg in file_result['messages']:
+            line = (msg['path'], msg['line'], msg['column'], msg['msg'])
+            if line in seen:
+                continue
+            seen.add(line)
+            if msg['module'] != module:
+                module = msg['module']
+                result += f'************* Module {module}\n'
+            result += f"{msg['path']}:{msg['line']}:{msg['column']}: "
+            result += f"{msg['msg_id']}: {msg['msg']} ({msg['symbol']})\n"
+    if note is None:
+        return result
+    result += '\n' + '-' * 70 + '\n'
+    result += f'Your code has been rated at {note:.2f}/10'
+    if previous is not None:
+        result += f' (previous run: {previous:.2f}/10, {note - previous:+.2f})'
+    result += '\n'
+    return result
+
+
+def load_previous_score(score_file):
+    try:
+        with open(score_file) as file:
+            return json.load(file)['score']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_score(score_file, note):
+    os.makedirs(os.path.dirname(score_file), exist_ok=True)
+    with open(score_file, 'w') as file:
+        json.dump({'score': note}, file)
+
+
+def run(paths=None, rcfile=RCFILE, jobs=None, cache_dir=CACHE_DIR,
+        score_file=SCORE_FILE, out=None):
+    out = out or sys.stdout
+    config = read_rcfile(rcfile)
+    whole_project = not paths
+    if whole_project:
+        paths = find_python_files('.', ignored_names(config))
+    rc_hash = hash_file(rcfile) if os.path.exists(rcfile) else ''
+    version = pylint_version()
+
+    # Split the files into cache hits and the ones which must be re-linted
+    keys = {path: cache_key(path, rc_hash, version) for path in paths}
+    results = {}
+    stale = []
+    for path in paths:
+        cached = load_cached(cache_dir, keys[path])
+        if cached is None:
+            stale.append(path)
+        else:
+            results[path] = cached
+
+    for result in lint_files(stale, rcfile, jobs):
+        store_cached(cache_dir, keys[result['path']], result)
+        results[result['path']] = result
+
+    # Only a run over the whole project knows which entries are obsolete
+    if whole_project:
+        prune_cache(cache_dir, set(keys.values()))
+
+    ordered = [results[path] for path in paths]
+    totals = total_stats(ordered)
+    note = score(totals, evaluation(config))
+    previous = load_previous_score(score_file)
+    out.write(format_report(ordered, note, previous))
+    # A partial run's score is no baseline for the next full one
+    if note is not None and whole_project:
+        store_score(score_file, note)
+    return exit_status(totals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run pylint on the changed files only, in parallel.')
+    parser.add_argument('paths', nargs='*',
+                        help='Files to lint. Defaults to all of the project.')
+    parser.add_argument('--rcfile', default=RCFILE)
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Worker processes. Defaults to the number of cores.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args(argv)
+    return run(args.paths, rcfile=args.rcfile, jobs=args.jobs,
+               cache_dir=args.cache_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,576 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import datetime
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+WORK_DIR = '.local-pipeline'
+CDK_OUT = 'cdk.out'
+
+# Never part of the source, even when .gitignore doesn't say so, along
+# with the work directory: what the pipeline installs or builds
+NOT_SOURCE = [CDK_OUT, 'node_modules', '.env']
+
+# The buildspec phases, in the order CodeBuild runs them
+PHASES = ['install', 'pre_build', 'build', 'post_build']
+
+# Deployments are only ever diffed locally
+CDK_COMMAND = re.compile(r'(?<![\w.-])cdk(?=\s)')
+CDK_VALUE_OPTIONS = {'-a', '--app', '-c', '--context', '-o', '--output', '-p', '--plugin',
+                     '--profile', '--proxy', '--ca-bundle-path', '-r', '--role-arn',
+                     '--require-approval', '--toolkit-stack-name'}
+REQUIRE_APPROVAL = re.compile(r'\s--require-approval[= ]\S+')
+
+# Linux's ioctl for cloning a file, copy-on-write
+FICLONE = 0x40049409
+
+START_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+END_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+print_lock = threading.Lock()
+
+
+def say(message):
+    with print_lock:
+        print(message, flush=True)
+
+
+# -----------------------------------------------------------
+# Reading the pipeline from the synthesized PipelineStack
+# -----------------------------------------------------------
+
+def template_path(stack, cdk_out=CDK_OUT):
+    return os.path.join(cdk_out, f'{stack}.template.json')
+
+
+def synth(stack, cdk_out=CDK_OUT):
+    subprocess.run(['cdk', 'synth', '--quiet', '-o', cdk_out, stack], check=True)
+
+
+def load_template(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def resource_id(value):
+    # Either a {'Ref': ...} to a resource in the template, or a plain name
+    if isinstance(value, dict):
+        return value.get('Ref')
+    return value
+
+
+def pipeline_layout(template):
+    resources = template.get('Resources', {})
+    pipelines = [r for r in resources.values() if r['Type'] == 'AWS::CodePipeline::Pipeline']
+    if not pipelines:
+        raise ValueError('The template defines no pipeline.')
+    projects = {}
+    for logical_id, resource in resources.items():
+        if resource['Type'] == 'AWS::CodeBuild::Project':
+            projects[logical_id] = resource['Properties']
+            if resource['Properties'].get('Name'):
+                projects[resource['Properties']['Name']] = resource['Properties']
+
+    stages = []
+    for stage in pipelines[0]['Properties']['Stages']:
+        actions = []
+        for action in stage['Actions']:
+            type_id = action['ActionTypeId']
+            project = action.get('Configuration', {}).get('ProjectName')
+            actions.append({
+                'name': action['Name'],
+                'category': type_id['Category'],
+                'provider': type_id['Provider'],
+                'project': projects.get(resource_id(project)) if project else None,
+                'inputs': [a['Name'] for a in action.get('InputArtifacts', [])],
+                'outputs': [a['Name'] for a in action.get('OutputArtifacts', [])],
+                'run_order': action.get('RunOrder', 1),
+            })
+        stages.append({'name': stage['Name'], 'actions': actions})
+    return stages
+
+
+def observer_settings(template):
+    # What PipelineStack configures the observer with, as far as the plain
+    # values go. The others refer to the resources of the stack.
+    for resource in template.get('Resources', {}).values():
+        if resource['Type'] != 'AWS::Lambda::Function':
+            continue
+        variables = resource['Properties'].get('Environment', {}).get('Variables', {})
+        if 'TEST_ACTION_NAME' in variables:
+            return {name: value for name, value in variables.items() if isinstance(value, str)}
+    return {}
+
+
+def load_buildspec(project, source_dir):
+    # Inline buildspecs are JSON; others name a file in the primary source
+    spec = project.get('Source', {}).get('BuildSpec', '')
+    try:
+        return json.loads(spec)
+    except ValueError:
+        pass
+    import yaml
+    path = os.path.join(source_dir, spec)
+    if os.path.isfile(path):
+        with open(path) as file:
+            return yaml.safe_load(file)
+    return yaml.safe_load(spec)
+
+
+def as_diff(command):
+    # Only the cdk subcommand itself is replaced: its first argument which
+    # is neither an option nor the value of one
+    match = CDK_COMMAND.search(command)
+    if not match:
+        return command
+    tokens = re.split(r'(\s+)', command[match.end():])
+    option_value = False
+    for i, token in enumerate(tokens):
+        if not token or token.isspace():
+            continue
+        if option_value:
+            option_value = False
+        elif token.startswith('-'):
+            option_value = token in CDK_VALUE_OPTIONS
+        elif token == 'deploy':
+            tokens[i] = 'diff'
+            return REQUIRE_APPROVAL.sub('', command[:match.end()] + ''.join(tokens))
+        else:
+            break
+    return command
+
+
+# -----------------------------------------------------------
+# Artifacts
+# -----------------------------------------------------------
+
+def link_or_copy(source, destination):
+    # Only for the artifact store, which nothing writes to once an action
+    # has handed its outputs on. Hard links make that nearly free.
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def clone_or_copy(source, destination):
+    # For the workspaces, which the actions are free to write to. A clone
+    # is as cheap as a link but copy-on-write, on file systems which can
+    # do it, such as btrfs and XFS. Elsewhere the file is copied.
+    try:
+        import fcntl
+        with open(source, 'rb') as original, open(destination, 'wb') as clone:
+            fcntl.ioctl(clone.fileno(), FICLONE, original.fileno())
+        shutil.copystat(source, destination)
+    except (ImportError, OSError):
+        shutil.copy2(source, destination)
+
+
+def copy_tree(source, destination, copy_file=clone_or_copy):
+    # Merges source into destination, keeping symlinks as they are
+    for dirpath, dirnames, filenames in os.walk(source):
+        target_dir = os.path.join(destination, os.path.relpath(dirpath, source))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            if os.path.islink(path):
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(os.readlink(path), target)
+            elif not os.path.isdir(path):
+                if os.path.lexists(target):
+                    os.remove(target)
+                copy_file(path, target)
+
+
+def tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            full = os.path.join(dirpath, filename)
+            if not os.path.islink(full):
+                total += os.path.getsize(full)
+    return total
+
+
+def source_files(work_dir=WORK_DIR):
+    # What a clone of the repo would contain, plus uncommitted changes
+    output = subprocess.run(['git', 'ls-files', '-z', '--cached', '--others',
+                             '--exclude-standard'],
+                            stdout=subprocess.PIPE, check=True).stdout
+    excluded = set(NOT_SOURCE + [os.path.relpath(work_dir).split(os.sep)[0]])
+    return [path for path in output.decode().split('\0')
+            if path and os.path.isfile(path) and path.split('/')[0] not in excluded]
+
+
+def export_source(destination, work_dir=WORK_DIR):
+    for path in source_files(work_dir):
+        target = os.path.join(destination, path)
+        os.makedirs(os.path.dirname(target) or destination, exist_ok=True)
+        # Copied rather than linked, so the build can't touch the work tree.
+        # What is there may be linked to elsewhere, so it is replaced rather
+        # than written to.
+        if os.path.lexists(target):
+            os.remove(target)
+        shutil.copy2(path, target)
+
+
+def collect_artifacts(spec, workspace, destination):
+    artifacts = spec.get('artifacts')
+    if not artifacts:
+        return
+    base = os.path.join(workspace, artifacts.get('base-directory', '.'))
+    files = artifacts.get('files', ['**/*'])
+    if '**/*' in files:
+        copy_tree(base, destination, link_or_copy)
+        return
+    for pattern in files:
+        for path in glob.glob(os.path.join(base, pattern), recursive=True):
+            if os.path.isdir(path):
+                continue
+            relative = os.path.relpath(path, base)
+            if artifacts.get('discard-paths') in ('yes', True):
+                relative = os.path.basename(relative)
+            target = os.path.join(destination, relative)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            link_or_copy(path, target)
+
+
+# -----------------------------------------------------------
+# Running the actions
+# -----------------------------------------------------------
+
+def phase_script(spec, marker_fd, diff_only):
+    # One shell runs all the phases, as in CodeBuild, so that cd, source
+    # and export carry over. The first failing command ends its phase,
+    # and post_build runs even when an earlier phase failed. The start
+    # and end of each phase are written to marker_fd for timing.
+    phases = spec.get('phases') or {}
+    script = ''
+    for phase in PHASES:
+        script += f'__phase_{phase}() {{\n:\n'
+        for command in (phases.get(phase) or {}).get('commands') or []:
+            if diff_only:
+                command = as_diff(command)
+            script += f'{command}\n'
+            script += '__rc=$?; if [ $__rc -ne 0 ]; then return $__rc; fi\n'
+        script += '}\n'
+    script += f"""
+__status=0
+for __phase in {' '.join(PHASES[:-1])}; do
+    echo "$__phase" >&{marker_fd}
+    echo "[$__phase]"
+    __phase_$__phase
+    __status=$?
+    if [ $__status -ne 0 ]; then break; fi
+done
+if [ $__status -eq 0 ]; then export CODEBUILD_BUILD_SUCCEEDING=1
+else export CODEBUILD_BUILD_SUCCEEDING=0; fi
+echo "{PHASES[-1]}" >&{marker_fd}
+echo "[{PHASES[-1]}]"
+__phase_{PHASES[-1]}
+__post_status=$?
+echo "done" >&{marker_fd}
+if [ $__status -ne 0 ]; then exit $__status; fi
+exit $__post_status
+"""
+    return script
+
+
+def run_phases(spec, workspace, env, log, diff_only):
+    # Returns the exit status and [(phase type, seconds)]
+    read_fd, write_fd = os.pipe()
+    process = subprocess.Popen(['bash', '-c', phase_script(spec, write_fd, diff_only)],
+                               cwd=workspace, env=env, stdout=log,
+                               stderr=subprocess.STDOUT, pass_fds=(write_fd,))
+    os.close(write_fd)
+    marks = []
+    with os.fdopen(read_fd) as markers:
+        for line in markers:
+            marks.append((line.strip(), time.time()))
+    status = process.wait()
+    timings = []
+    for (phase, started), (_, ended) in zip(marks, marks[1:]):
+        timings.append((phase.upper(), round(ended - started, 1)))
+    return status, timings
+
+
+def artifact_dir(work_dir, name):
+    return os.path.join(work_dir, 'artifacts', name)
+
+
+def reset(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def utc(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def deploys(spec):
+    phases = (spec or {}).get('phases') or {}
+    return any(as_diff(command) != command
+               for phase in phases.values() if phase
+               for command in phase.get('commands') or [])
+
+
+def sandbox(env, work_dir, home):
+    # Buildspecs are written for throwaway containers and may change the
+    # global npm configuration, install global npm packages or fill caches
+    # in the home directory. Each action gets a home of its own instead,
+    # with its own npm prefix for global packages, and the npm and pip
+    # caches are kept in the work directory, shared by the actions.
+    home = os.path.abspath(home)
+    cache = os.path.abspath(os.path.join(work_dir, 'cache'))
+    prefix = os.path.join(home, '.npm-global')
+    settings = {
+        'HOME': home,
+        'XDG_CONFIG_HOME': os.path.join(home, '.config'),
+        'XDG_CACHE_HOME': os.path.join(home, '.cache'),
+        'npm_config_userconfig': os.path.join(home, '.npmrc'),
+        'npm_config_globalconfig': os.path.join(home, 'npmrc'),
+        'npm_config_prefix': prefix,
+        'npm_config_cache': os.path.join(cache, 'npm'),
+        'PIP_CACHE_DIR': os.path.join(cache, 'pip'),
+    }
+    # npm reads its settings from the environment whatever their case
+    for name in list(env):
+        if name.lower() in settings and name not in settings:
+            del env[name]
+    env.update(settings)
+    env['PATH'] = os.pathsep.join(p for p in [os.path.join(prefix, 'bin'), env.get('PATH')] if p)
+    return env
+
+
+def run_codebuild(action, stage, work_dir, diff, log_path):
+    # Returns the state and the timed phases of the action
+    workspace = os.path.join(work_dir, 'work', stage, action['name'])
+    home = os.path.join(work_dir, 'home', stage, action['name'])
+    started = time.time()
+    reset(workspace)
+    reset(home)
+    env = sandbox(dict(os.environ), work_dir, home)
+    env.update(CODEBUILD_SRC_DIR=os.path.abspath(workspace), CODEBUILD_BUILD_SUCCEEDING='1')
+    for i, name in enumerate(action['inputs']):
+        if i == 0:
+            copy_tree(artifact_dir(work_dir, name), workspace)
+        else:
+            # Secondary inputs go beside the primary one, as in CodeBuild
+            secondary = f'{workspace}_{name}'
+            reset(secondary)
+            copy_tree(artifact_dir(work_dir, name), secondary)
+            env[f'CODEBUILD_SRC_DIR_{name}'] = os.path.abspath(secondary)
+    phases = [('DOWNLOAD_SOURCE', round(time.time() - started, 1))]
+
+    project = action['project']
+    spec = load_buildspec(project, workspace)
+    if deploys(spec) and not diff:
+        return 'SKIPPED', phases
+    for variable in project.get('Environment', {}).get('EnvironmentVariables', []):
+        if isinstance(variable.get('Value'), str):
+            env[variable['Name']] = variable['Value']
+    for name, value in ((spec.get('env') or {}).get('variables') or {}).items():
+        env[name] = str(value)
+
+    with open(log_path, 'w') as log:
+        status, timings = run_phases(spec, workspace, env, log, diff_only=True)
+    phases += timings
+    if status != 0:
+        return 'FAILED', phases
+
+    started = time.time()
+    for name in action['outputs']:
+        reset(artifact_dir(work_dir, name))
+        collect_artifacts(spec, workspace, artifact_dir(work_dir, name))
+    phases.append(('UPLOAD_ARTIFACTS', round(time.time() - started, 1)))
+    return 'SUCCEEDED', phases
+
+
+def run_action(action, stage, work_dir, diff, reuse, source_artifacts):
+    started = time.time()
+    log_path = os.path.join(work_dir, 'logs', f"{stage}.{action['name']}.log")
+    phases = []
+    if action['category'] == 'Source':
+        # The work tree stands in for whatever the pipeline's source is
+        begun = time.time()
+        for name in action['outputs']:
+            reset(artifact_dir(work_dir, name))
+            export_source(artifact_dir(work_dir, name), work_dir)
+        phases.append(('DOWNLOAD_SOURCE', round(time.time() - begun, 1)))
+        state = 'SUCCEEDED'
+    elif stage in reuse and all(os.path.isdir(artifact_dir(work_dir, name))
+                                for name in action['outputs']):
+        # Last run's outputs, brought up to date with the current source
+        # if that is what the action was given
+        if set(action['inputs']) & set(source_artifacts):
+            for name in action['outputs']:
+                export_source(artifact_dir(work_dir, name), work_dir)
+        state = 'SUCCEEDED'
+    elif action['provider'] == 'CodeBuild' and action['project']:
+        state, phases = run_codebuild(action, stage, work_dir, diff, log_path)
+    else:
+        state = 'SKIPPED'
+    ended = time.time()
+    say(f"    {action['name']} {state.lower()} after {ended - started:.1f}s"
+        + (f' (see {log_path})' if state == 'FAILED' else ''))
+    return {
+        'name': action['name'],
+        'state': state,
+        'started': started,
+        'ended': ended,
+        'phases': phases,
+        'inputs': [tree_size(artifact_dir(work_dir, name)) for name in action['inputs']
+                   if os.path.isdir(artifact_dir(work_dir, name))],
+        'outputs': [tree_size(artifact_dir(work_dir, name)) for name in action['outputs']
+                    if os.path.isdir(artifact_dir(work_dir, name))],
+    }
+
+
+def run_stage(stage, work_dir, diff, reuse, source_artifacts):
+    # Actions sharing a run order run side by side, like in CodePipeline
+    results = []
+    for run_order in sorted({action['run_order'] for action in stage['actions']}):
+        group = [a for a in stage['actions'] if a['run_order'] == run_order]
+        with ThreadPoolExecutor(max_workers=len(group)) as executor:
+            group_results = list(executor.map(
+                lambda action: run_action(action, stage['name'], work_dir, diff,
+                                          reuse, source_artifacts),
+                group))
+        results += group_results
+        if any(result['state'] == 'FAILED' for result in group_results):
+            break
+    return results
+
+
+def run_pipeline(layout, work_dir=WORK_DIR, diff=True, reuse=()):
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    source_artifacts = [name for stage in layout for action in stage['actions']
+                        if action['category'] == 'Source' for name in action['outputs']]
+    started = time.time()
+    stages = []
+    state = 'SUCCEEDED'
+    for stage in layout:
+        say(f"Stage {stage['name']}")
+        stage_started = time.time()
+        results = run_stage(stage, work_dir, diff, reuse, source_artifacts)
+        stage_state = 'FAILED' if any(r['state'] == 'FAILED' for r in results) else 'SUCCEEDED'
+        stages.append({'name': stage['name'], 'state': stage_state,
+                       'started': stage_started, 'ended': time.time(),
+                       'actions': results})
+        if stage_state == 'FAILED':
+            state = 'FAILED'
+            break
+    return {'state': state, 'started': started, 'ended': time.time(), 'stages': stages}
+
+
+# -----------------------------------------------------------
+# The report, rendered by the pipeline observer
+# -----------------------------------------------------------
+
+def job_records(run):
+    # The stage records the observer would have kept in its Jobs table
+    def record(stage, action, item):
+        return {
+            'stage': stage if action == 'None' else f'{stage}: {action}',
+            'action': action,
+            'state': item['state'],
+            'started': utc(item['started']).strftime(START_FORMAT),
+            'ended': utc(item['ended']).strftime(END_FORMAT),
+        }
+    records = [record('AJOB', 'None', run)]
+    for stage in run['stages']:
+        records.append(record(stage['name'], 'None', stage))
+        for action in stage['actions']:
+            records.append(record(stage['name'], action['name'], action))
+    return records
+
+
+def action_metrics(run):
+    return {action['name']: {key: action[key] for key in ['phases', 'inputs', 'outputs']}
+            for stage in run['stages'] for action in stage['actions']}
+
+
+def test_results(observer, run, layout, work_dir):
+    names = [observer.LINT_FILE, observer.TEST_FILE, observer.COVERAGE_FILE]
+    outputs = [name for stage in layout for action in stage['actions']
+               if action['name'] == observer.TEST_ACTION_NAME
+               for name in action['outputs']]
+    ran = any(action['name'] == observer.TEST_ACTION_NAME and action['state'] != 'SKIPPED'
+              for stage in run['stages'] for action in stage['actions'])
+    result = dict.fromkeys(names, 'Not run.')
+    if not outputs or not ran:
+        return result
+    for name in names:
+        try:
+            with open(os.path.join(artifact_dir(work_dir, outputs[0]), name)) as file:
+                result[name] = file.read().strip()
+        except OSError:
+            result[name] = 'Could not be read.'
+    return result
+
+
+def git(*args):
+    completed = subprocess.run(['git', *args], stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, universal_newlines=True)
+    return completed.stdout.strip()
+
+
+def report(run, layout, work_dir, settings=None):
+    from ci import observer_module
+    observer = observer_module.load_observer(env=settings)
+    source_desc = observer.source_string(
+        git('rev-parse', 'HEAD') or 'local', git('log', '-1', '--format=%s') or '',
+        git('remote', 'get-url', 'origin'))
+    return observer.format_report(run['state'], source_desc, job_records(run),
+                                  action_metrics(run),
+                                  test_results(observer, run, layout, work_dir))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a PipelineStack pipeline locally, deploying in diff mode.')
+    parser.add_argument('stack', nargs='?', default='pipeline-dev',
+                        help='The pipeline stack to run.')
+    parser.add_argument('--template', help='The synthesized template of the stack. '
+                        f'Defaults to {CDK_OUT}/<stack>.template.json.')
+    parser.add_argument('--synth', action='store_true',
+                        help='Synthesize the stack first, even if there is a template.')
+    parser.add_argument('--reuse', default='',
+                        help='Comma separated stages whose outputs from the last run '
+                        'to reuse, refreshed with the current source, e.g. Install.')
+    parser.add_argument('--no-deploy', dest='diff', action='store_false',
+                        help='Skip the deployments instead of diffing them.')
+    parser.add_argument('--work-dir', default=WORK_DIR)
+    args = parser.parse_args(argv)
+
+    path = args.template or template_path(args.stack)
+    if args.synth or not os.path.exists(path):
+        synth(args.stack)
+    template = load_template(path)
+    layout = pipeline_layout(template)
+    run = run_pipeline(layout, args.work_dir, diff=args.diff,
+                       reuse=[stage for stage in args.reuse.split(',') if stage])
+
+    try:
+        text = report(run, layout, args.work_dir, observer_settings(template))
+    except ImportError as e:
+        say(f'The report needs the dependencies of the observer: {e}')
+    else:
+        with open(os.path.join(args.work_dir, 'report.txt'), 'w') as file:
+            file.write(text)
+        say('\n' + text.replace('\r\n', '\n'))
+    return 0 if run['state'] == 'SUCCEEDED' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
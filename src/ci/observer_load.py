@@ -0,0 +1,605 @@
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import tempfile
+import logging
+import argparse
+import datetime
+import threading
+from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
+
+from ci import observer_module
+from ci.observer_module import OBSERVER_ENV, OBSERVER_PATH
+
+JOB_MARKER = 'AJOB'
+
+# The stages and actions of a PipelineStack with a single service stack,
+# with typical durations in seconds
+PIPELINE_LAYOUT = [
+    ('Source', [('CodeCommit', 5)]),
+    ('Install', [('Dependencies', 120)]),
+    ('TestAndBuild', [('Test', 90), ('Build', 100)]),
+    ('DeployPipeline', [('pipeline-dev', 60)]),
+    ('DeployWorkload', [('app-dev', 90)]),
+]
+
+DETAIL_TYPES = {
+    'pipeline': 'CodePipeline Pipeline Execution State Change',
+    'stage': 'CodePipeline Stage Execution State Change',
+    'action': 'CodePipeline Action Execution State Change',
+}
+
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# How the builds of the stand-in CodeBuild spend their time
+BUILD_PHASES = [
+    ('SUBMITTED', 0.0), ('QUEUED', 0.05), ('PROVISIONING', 0.25),
+    ('DOWNLOAD_SOURCE', 0.1), ('INSTALL', 0.05), ('PRE_BUILD', 0.05),
+    ('BUILD', 0.4), ('POST_BUILD', 0.0), ('UPLOAD_ARTIFACTS', 0.1),
+]
+ARTIFACT_SIZE = 50 * 1024 * 1024
+
+
+# -----------------------------------------------------------
+# Synthesizing and loading event streams
+# -----------------------------------------------------------
+
+def make_event(when, pipeline, exec_id, state, stage=None, action=None):
+    detail = {
+        'pipeline': pipeline,
+        'execution-id': exec_id,
+        'state': state,
+        'version': 1,
+    }
+    kind = 'pipeline'
+    if stage:
+        detail['stage'] = stage
+        kind = 'stage'
+    if action:
+        detail['action'] = action
+        kind = 'action'
+    return {
+        'source': 'aws.codepipeline',
+        'detail-type': DETAIL_TYPES[kind],
+        'time': when.strftime(EVENT_TIME_FORMAT),
+        'detail': detail,
+    }
+
+
+def synthesize_execution(pipeline, exec_id, started, layout=None):
+    # The events of one successful execution, in the order CodePipeline
+    # emits them, each paired with its offset in seconds from the start
+    layout = layout or PIPELINE_LAYOUT
+    at = datetime.timedelta
+    events = [(0, make_event(started, pipeline, exec_id, 'STARTED'))]
+    offset = 0
+    for stage, actions in layout:
+        events.append((offset, make_event(started + at(seconds=offset),
+                                          pipeline, exec_id, 'STARTED', stage)))
+        for action, _ in actions:
+            events.append((offset, make_event(started + at(seconds=offset),
+                                              pipeline, exec_id, 'STARTED', stage, action)))
+        for action, seconds in sorted(actions, key=lambda x: x[1]):
+            events.append((offset + seconds, make_event(started + at(seconds=offset + seconds),
+                                                        pipeline, exec_id, 'SUCCEEDED',
+                                                        stage, action)))
+        offset += max(seconds for _, seconds in actions)
+        events.append((offset, make_event(started + at(seconds=offset),
+                                          pipeline, exec_id, 'SUCCEEDED', stage)))
+    events.append((offset, make_event(started + at(seconds=offset),
+                                      pipeline, exec_id, 'SUCCEEDED')))
+    return events
+
+
+def synthesize(executions, pipeline='YourApp_dev', spacing=30, seed=None):
+    # Overlapping executions, one starting every 'spacing' seconds
+    rng = random.Random(seed)
+    started = datetime.datetime.utcnow().replace(microsecond=0)
+    result = []
+    for i in range(executions):
+        exec_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        start = i * spacing
+        for offset, event in synthesize_execution(
+                pipeline, exec_id, started + datetime.timedelta(seconds=start)):
+            result.append((start + offset, event))
+    result.sort(key=lambda x: x[0])
+    return result
+
+
+def load_events(path):
+    # Recorded EventBridge events, one JSON document per line, in the
+    # order they happened, timed by their 'time' fields
+    with open(path) as file:
+        events = [json.loads(line) for line in file if line.strip()]
+    if not events:
+        return []
+    first = datetime.datetime.strptime(events[0]['time'], EVENT_TIME_FORMAT)
+    return [((datetime.datetime.strptime(event['time'], EVENT_TIME_FORMAT) - first)
+             .total_seconds(), event)
+            for event in events]
+
+
+def disorder(timeline, delayed=0.0, duplicated=0.0, max_delay=5.0, seed=None):
+    # Turns the true timeline into a delivery schedule. Some events are
+    # held back, letting later ones overtake them, and some are delivered
+    # a second time, as EventBridge and SNS are both at-least-once.
+    rng = random.Random(seed)
+    deliveries = []
+    counts = {'delayed': 0, 'duplicated': 0}
+    for order, (at, event) in enumerate(timeline):
+        when = at
+        if rng.random() < delayed:
+            when += rng.uniform(0, max_delay)
+            counts['delayed'] += 1
+        deliveries.append((when, order, event))
+        if rng.random() < duplicated:
+            deliveries.append((when + rng.uniform(0, max_delay), order, event))
+            counts['duplicated'] += 1
+    deliveries.sort(key=lambda x: (x[0], x[1]))
+    return deliveries, counts
+
+
+def composite_stage(detail):
+    # The sort key the observer files an event under
+    stage = detail.get('stage') or JOB_MARKER
+    action = detail.get('action') or 'None'
+    return stage if action == 'None' else f'{stage}: {action}'
+
+
+def expected_records(timeline):
+    # The final state of every stage record, going by the true order
+    result = {}
+    for _, event in timeline:
+        detail = event['detail']
+        result[(detail['execution-id'], composite_stage(detail))] = detail['state']
+    return result
+
+
+def expected_actions(timeline):
+    result = {}
+    for _, event in timeline:
+        detail = event['detail']
+        if detail.get('action'):
+            result.setdefault(detail['execution-id'], set()).add(detail['action'])
+    return result
+
+
+def sns_record(event):
+    return {'Records': [{'Sns': {'Message': json.dumps(event)}}]}
+
+
+# -----------------------------------------------------------
+# Local stand-ins for the AWS services
+# -----------------------------------------------------------
+
+class Clock:
+
+    def __init__(self, scale):
+        # Real seconds per simulated second
+        self.scale = scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.scale)
+
+
+class FakeTable:
+
+    def __init__(self, clock, latency=0.0):
+        self.clock = clock
+        self.latency = latency
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def _call(self):
+        if self.latency:
+            self.clock.sleep(self.latency)
+
+    def put_item(self, Item):
+        self._call()
+        with self.lock:
+            self.items[(Item['exec_id'], Item['stage'])] = dict(Item)
+
+    def get_item(self, Key, **_kwargs):
+        self._call()
+        with self.lock:
+            item = self.items.get((Key['exec_id'], Key['stage']))
+        return {'Item': dict(item)} if item else {}
+
+    def query(self, KeyConditionExpression, **_kwargs):
+        self._call()
+        exec_id = key_condition_value(KeyConditionExpression)
+        with self.lock:
+            items = [dict(item) for (key, _), item in self.items.items() if key == exec_id]
+        return {'Items': items}
+
+
+def key_condition_value(condition):
+    # Key('exec_id').eq(x) from boto3, or just x
+    expression = getattr(condition, 'get_expression', None)
+    if expression:
+        return expression()['values'][1]
+    return condition
+
+
+class FakeSNS:
+
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def publish(self, TopicArn, Message):
+        with self.lock:
+            self.messages.append(Message)
+        return {'MessageId': str(uuid.uuid4())}
+
+
+class FakeCodePipeline:
+
+    def __init__(self, clock, latency=0.0):
+        self.clock = clock
+        self.latency = latency
+
+    def _call(self):
+        if self.latency:
+            self.clock.sleep(self.latency)
+
+    def get_pipeline_execution(self, pipelineName, pipelineExecutionId):
+        self._call()
+        return {
+            'pipelineExecution': {
+                'pipelineName': pipelineName,
+                'pipelineExecutionId': pipelineExecutionId,
+                # The report shows the first 8 characters of the commit id,
+                # which lets us tell which execution a report is about
+                'artifactRevisions': [{
+                    'revisionId': pipelineExecutionId.replace('-', ''),
+                    'revisionSummary': 'Load test',
+                    'revisionUrl': 'https://example.com/commit',
+                }],
+            },
+        }
+
+    def get_pipeline(self, name):
+        self._call()
+        return {'pipeline': {'name': name}}
+
+    def get_pipeline_state(self, name):
+        self._call()
+        return {'pipelineName': name, 'stageStates': []}
+
+    def list_action_executions(self, pipelineName, filter):   # pylint: disable=redefined-builtin
+        self._call()
+        exec_id = filter['pipelineExecutionId']
+        details = []
+        for stage, actions in PIPELINE_LAYOUT[1:]:
+            for action, _ in actions:
+                details.append({
+                    'pipelineExecutionId': exec_id,
+                    'stageName': stage,
+                    'actionName': action,
+                    'input': {
+                        'actionTypeId': {'provider': 'CodeBuild'},
+                        'inputArtifacts': [{
+                            's3location': {'bucket': 'artifacts', 'key': f'{exec_id}/input'},
+                        }],
+                    },
+                    'output': {
+                        'executionResult': {'externalExecutionId': f'{action}:{exec_id}'},
+                        'outputArtifacts': [{
+                            's3location': {'bucket': 'artifacts', 'key': exec_id},
+                        }],
+                    },
+                })
+        return {'actionExecutionDetails': details}
+
+
+class FakeCodeBuild:
+
+    def __init__(self, clock, latency=0.0):
+        self.clock = clock
+        self.latency = latency
+        self.durations = dict(action for _, actions in PIPELINE_LAYOUT for action in actions)
+
+    def batch_get_builds(self, ids):
+        if self.latency:
+            self.clock.sleep(self.latency)
+        builds = []
+        for build_id in ids:
+            seconds = self.durations.get(build_id.split(':', 1)[0], 60)
+            builds.append({
+                'id': build_id,
+                'phases': [{'phaseType': phase, 'durationInSeconds': round(share * seconds)}
+                           for phase, share in BUILD_PHASES],
+            })
+        return {'builds': builds, 'buildsNotFound': []}
+
+
+class FakeBucket:
+
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+
+    def download_file(self, key, path):
+        self.s3.clock.sleep(self.s3.latency)
+        with open(path, 'wb') as file:
+            file.write(self.s3.archive)
+
+
+class FakeObject:
+
+    def __init__(self, s3, bucket, key):
+        s3.clock.sleep(s3.latency)
+        self.bucket_name = bucket
+        self.key = key
+        self.content_length = len(s3.archive) if key.count('/') == 0 else ARTIFACT_SIZE
+
+
+class FakeS3:
+
+    def __init__(self, clock, latency=0.0):
+        self.clock = clock
+        self.latency = latency
+        buffer = io.BytesIO()
+        with ZipFile(buffer, 'w') as archive:
+            for name in ['LINT_FILE', 'TEST_FILE', 'COVERAGE_FILE']:
+                archive.writestr(OBSERVER_ENV[name], f'{OBSERVER_ENV[name]} contents')
+        self.archive = buffer.getvalue()
+
+    def Bucket(self, name):   # pylint: disable=invalid-name
+        return FakeBucket(self, name)
+
+    def Object(self, bucket, key):   # pylint: disable=invalid-name
+        return FakeObject(self, bucket, key)
+
+
+# -----------------------------------------------------------
+# Replaying
+# -----------------------------------------------------------
+
+def load_observer(path=OBSERVER_PATH):
+    observer = observer_module.load_observer(path, OBSERVER_ENV)
+    # Each Lambda container has a /tmp of its own, whereas our invocations
+    # share one, so each gets a directory of its own to unpack into
+    get_test_results = observer.get_test_results
+
+    def isolated_get_test_results(*args):
+        with tempfile.TemporaryDirectory(prefix='observer-') as base_dir:
+            return get_test_results(*args, base_dir=base_dir)
+    observer.get_test_results = isolated_get_test_results
+    return observer
+
+
+def install_fakes(observer, clock, latency):
+    fakes = {
+        'job_table': FakeTable(clock, latency),
+        'sns_client': FakeSNS(),
+        'codepipeline_client': FakeCodePipeline(clock, latency),
+        'codebuild_client': FakeCodeBuild(clock, latency),
+        's3': FakeS3(clock, latency),
+    }
+    for name, fake in fakes.items():
+        setattr(observer, name, fake)
+    observer.sleep = clock.sleep
+    return fakes
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def check_records(table_items, expected):
+    lost = []
+    corrupted = []
+    for key, state in expected.items():
+        item = table_items.get(key)
+        if item is None:
+            lost.append(key)
+        elif item.get('state') != state or not item.get('started') or \
+                (state not in ('STARTED', 'RESUMED') and not item.get('ended')):
+            corrupted.append(key)
+    return lost, corrupted
+
+
+def check_reports(messages, actions):
+    # Who the reports are about, and whether they list every action
+    by_commit = {exec_id.replace('-', '')[:8]: exec_id for exec_id in actions}
+    counts = dict.fromkeys(actions, 0)
+    incomplete = set()
+    for message in messages:
+        commit = message.split('[', 1)[-1][:8]
+        exec_id = by_commit.get(commit)
+        if exec_id is None:
+            continue
+        counts[exec_id] += 1
+        # The action lines are indented with non-breaking spaces
+        lines = [line.strip() for line in message.splitlines()]
+        for action in actions[exec_id]:
+            if not any(line.startswith(f'{action} succeeded') for line in lines):
+                incomplete.add(exec_id)
+    missing = [e for e, n in counts.items() if n == 0]
+    duplicates = sum(n - 1 for n in counts.values() if n > 1)
+    return missing, duplicates, sorted(incomplete)
+
+
+def busy_time(intervals):
+    # How long at least one invocation was running
+    total = 0.0
+    end = None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+def replay(observer, timeline, rate=1.0, concurrency=100, scale=0.01, latency=0.01,
+           delayed=0.0, duplicated=0.0, max_delay=5.0, seed=None):
+    # Each event is delivered at its simulated delivery time, 'rate' times
+    # faster than the timeline has it. All simulated times, including the
+    # observer's own sleeps, run 'scale' times real time.
+    clock = Clock(scale)
+    fakes = install_fakes(observer, clock, latency)
+    deliveries, counts = disorder(timeline, delayed, duplicated, max_delay, seed)
+
+    intervals = []
+    errors = []
+    lock = threading.Lock()
+
+    def invoke(event):
+        started = time.perf_counter()
+        try:
+            observer.handler(sns_record(event), None)
+        except Exception as e:   # pylint: disable=broad-except
+            with lock:
+                errors.append(repr(e))
+        with lock:
+            intervals.append((started, time.perf_counter()))
+
+    # The observer logs every event it gets, which would drown the results
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARNING)
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for when, _, event in deliveries:
+                delay = started + when / rate * scale - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(invoke, event)
+    finally:
+        logging.getLogger().setLevel(level)
+    # In simulated seconds from here on
+    busy = busy_time(intervals) / scale
+    latencies = [(stop - start) / scale for start, stop in intervals]
+
+    lost, corrupted = check_records(fakes['job_table'].items, expected_records(timeline))
+    missing, duplicates, incomplete = check_reports(fakes['sns_client'].messages,
+                                                    expected_actions(timeline))
+    return {
+        'executions': len(expected_actions(timeline)),
+        'events': len(deliveries),
+        'delayed': counts['delayed'],
+        'duplicated': counts['duplicated'],
+        'span': deliveries[-1][0] / rate if deliveries else 0.0,
+        'busy': busy,
+        'throughput': len(deliveries) / busy if busy else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies, default=0.0),
+        'errors': errors,
+        'records': len(expected_records(timeline)),
+        'lost': lost,
+        'corrupted': corrupted,
+        'missing_reports': missing,
+        'duplicate_reports': duplicates,
+        'incomplete_reports': incomplete,
+    }
+
+
+def healthy(result):
+    return not (result['errors'] or result['lost'] or result['corrupted'] or
+                result['missing_reports'] or result['duplicate_reports'] or
+                result['incomplete_reports'])
+
+
+def format_result(result):
+    out = f"Executions: {result['executions']}, events: {result['events']} "
+    out += f"({result['delayed']} delayed, {result['duplicated']} duplicated)\n"
+    out += f"Delivered over {result['span']:.0f} simulated s, handlers busy "
+    out += f"{result['busy']:.0f} s of it\n"
+    out += f"Throughput: {result['throughput']:.1f} events per busy second\n"
+    out += f"Handler latency (simulated s): p50 {result['p50']:.2f}, "
+    out += f"p90 {result['p90']:.2f}, p99 {result['p99']:.2f}, max {result['max']:.2f}\n"
+    out += f"Errors: {len(result['errors'])}\n"
+    for error in sorted(set(result['errors'])):
+        out += f"    {error}\n"
+    out += f"Stage records: {result['records']} expected, {len(result['lost'])} lost, "
+    out += f"{len(result['corrupted'])} corrupted\n"
+    out += f"Reports: {result['executions']} expected, "
+    out += f"{len(result['missing_reports'])} missing, "
+    out += f"{result['duplicate_reports']} duplicate, "
+    out += f"{len(result['incomplete_reports'])} incomplete\n"
+    return out
+
+
+def format_sweep(results):
+    out = f"{'Executions':>10} {'Events/s':>9} {'p50':>7} {'p99':>7} {'Errors':>7} "
+    out += f"{'Lost':>5} {'Corrupt':>8} {'Missing':>8} {'Dupes':>6} {'Partial':>8}\n"
+    for result in results:
+        out += f"{result['executions']:>10} {result['throughput']:>9.1f} "
+        out += f"{result['p50']:>7.2f} {result['p99']:>7.2f} {len(result['errors']):>7} "
+        out += f"{len(result['lost']):>5} {len(result['corrupted']):>8} "
+        out += f"{len(result['missing_reports']):>8} {result['duplicate_reports']:>6} "
+        out += f"{len(result['incomplete_reports']):>8}\n"
+    broken = next((r['executions'] for r in results if not healthy(r)), None)
+    if broken is None:
+        out += 'All reports were correct.\n'
+    else:
+        out += f'Reports first went wrong at {broken} concurrent executions.\n'
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay CodePipeline events against the pipeline observer.')
+    parser.add_argument('--events', help='Recorded events, one JSON document per line. '
+                        'Synthesized if not given.')
+    parser.add_argument('--executions', default='4',
+                        help='Concurrent executions to synthesize, or a comma '
+                        'separated list of them to sweep through.')
+    parser.add_argument('--spacing', type=float, default=30,
+                        help='Seconds between the starts of the executions.')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='Speed-up of the deliveries over the timeline, '
+                        '1 delivering each event at its own time.')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='Maximum concurrent observer invocations.')
+    parser.add_argument('--scale', type=float, default=0.01,
+                        help='Real seconds per simulated second.')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Simulated seconds per AWS call.')
+    parser.add_argument('--delayed', type=float, default=0.05,
+                        help='Fraction of events delivered late.')
+    parser.add_argument('--duplicated', type=float, default=0.02,
+                        help='Fraction of events delivered twice.')
+    parser.add_argument('--max-delay', type=float, default=5.0,
+                        help='Longest delay of a late or duplicate event, in seconds.')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    observer = load_observer()
+    options = dict(rate=args.rate, concurrency=args.concurrency, scale=args.scale,
+                   latency=args.latency, delayed=args.delayed,
+                   duplicated=args.duplicated, max_delay=args.max_delay, seed=args.seed)
+
+    if args.events:
+        result = replay(observer, load_events(args.events), **options)
+        sys.stdout.write(format_result(result))
+        return 0 if healthy(result) else 1
+
+    levels = [int(level) for level in args.executions.split(',')]
+    results = []
+    for level in levels:
+        timeline = synthesize(level, spacing=args.spacing, seed=args.seed)
+        results.append(replay(observer, timeline, **options))
+        if len(levels) == 1:
+            sys.stdout.write(format_result(results[0]))
+    if len(levels) > 1:
+        sys.stdout.write(format_sweep(results))
+    return 0 if all(healthy(r) for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+import os
+import logging
+import importlib.util
+
+
+OBSERVER_PATH = os.path.join(os.path.dirname(__file__), '..', 'lambdas', 'pipeline_observer.py')
+
+# Mirrors what PipelineStack passes to the observer. The AWS resources
+# named here are placeholders: whoever loads the observer outside Lambda
+# either swaps its clients for stand-ins or only uses its formatting.
+OBSERVER_ENV = {
+    'OUTPUT_SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:000000000000:observer',
+    'JOB_TABLE_NAME': 'Jobs',
+    'TEST_ACTION_NAME': 'Test',
+    'LINT_FILE': 'pylint.out',
+    'TEST_FILE': 'pytest.out',
+    'COVERAGE_FILE': 'coverage.out',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+}
+
+
+def load_observer(path=OBSERVER_PATH, env=None):
+    # A fresh copy of the observer's module, configured the way a Lambda
+    # container would configure it: from the environment, falling back on
+    # OBSERVER_ENV, with 'env' taking precedence over both. The settings
+    # are only in os.environ while the module loads, and the root logger,
+    # which the observer turns up to INFO, is left as it was.
+    settings = {name: os.environ.get(name, value) for name, value in OBSERVER_ENV.items()}
+    settings.update(env or {})
+    saved = {name: os.environ.get(name) for name in settings}
+    level = logging.getLogger().level
+    os.environ.update(settings)
+    try:
+        spec = importlib.util.spec_from_file_location('pipeline_observer', path)
+        observer = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(observer)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        logging.getLogger().setLevel(level)
+    return observer
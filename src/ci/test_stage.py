@@ -0,0 +1,217 @@
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import subprocess
+import configparser
+
+
+# The files picked up by the pipeline observer
+LINT_FILE = 'pylint.out'
+TEST_FILE = 'pytest.out'
+COVERAGE_FILE = 'coverage.out'
+
+PYTEST_INI = 'pytest.ini'
+PYTEST_CACHE = '.pytest_cache'
+DEFAULT_PYTHON_FILES = 'test_*.py *_test.py'
+
+# The counters on pytest's summary line, in the order pytest uses
+OUTCOMES = ['failed', 'passed', 'skipped', 'deselected', 'xfailed', 'xpassed',
+            'warnings', 'errors']
+OUTCOME_PATTERN = re.compile(
+    r'(\d+) (failed|passed|skipped|deselected|xfailed|xpassed|warnings?|errors?)')
+SUMMARY_PATTERN = re.compile(r'^=+ .* in [\d.]+s.* =+$')
+
+# Pytest's exit status when a run collects no tests at all
+NO_TESTS_COLLECTED = 5
+
+
+# -----------------------------------------------------------
+# Finding and sharding the tests
+# -----------------------------------------------------------
+
+def read_pytest_ini(path=PYTEST_INI):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    testpaths = config.get('pytest', 'testpaths', fallback='.').split()
+    patterns = config.get('pytest', 'python_files', fallback=DEFAULT_PYTHON_FILES).split()
+    return testpaths, patterns
+
+
+def find_test_files(testpaths, patterns):
+    result = set()
+    for testpath in testpaths:
+        for pattern in patterns:
+            result.update(glob.glob(os.path.join(testpath, '**', pattern),
+                                    recursive=True))
+    return sorted(result)
+
+
+def shard(files, workers):
+    # Longest first onto the least loaded shard, using the file size as
+    # a stand-in for the time the tests in it will take
+    shards = [[] for _ in range(min(workers, len(files)))]
+    loads = [0] * len(shards)
+    for path in sorted(files, key=os.path.getsize, reverse=True):
+        i = loads.index(min(loads))
+        shards[i].append(path)
+        loads[i] += os.path.getsize(path) + 1
+    return [sorted(files) for files in shards]
+
+
+# -----------------------------------------------------------
+# Running things side by side
+# -----------------------------------------------------------
+
+def environment():
+    env = dict(os.environ)
+    src = os.path.abspath('src')
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in [src, env.get('PYTHONPATH')] if p)
+    return env
+
+
+def start(args, output):
+    return subprocess.Popen(args, stdout=output, stderr=subprocess.STDOUT,
+                            env=environment())
+
+
+def split_cores(cores, workers=None, lint=True):
+    # The linter and the test workers share the cores rather than each
+    # taking all of them: half for the linter, the rest for the tests
+    if not lint:
+        return 0, workers or cores
+    if workers:
+        return max(1, cores - workers), workers
+    lint_jobs = max(1, cores // 2)
+    return lint_jobs, max(1, cores - lint_jobs)
+
+
+def start_lint(lint_output, jobs):
+    return start([sys.executable, '-m', 'ci.lint', f'--jobs={jobs}'], lint_output)
+
+
+def start_shard(number, files, output):
+    # Parallel mode gives each worker its own .coverage.* data file, and
+    # each worker gets its own pytest cache so they don't write over each other
+    cache_dir = os.path.join(PYTEST_CACHE, f'worker-{number}')
+    return start([sys.executable, '-m', 'coverage', 'run', '--parallel-mode',
+                  '-m', 'pytest', '-rA', '-o', f'cache_dir={cache_dir}', *files], output)
+
+
+def remove_coverage_data():
+    for path in glob.glob('.coverage') + glob.glob('.coverage.*'):
+        os.remove(path)
+
+
+# -----------------------------------------------------------
+# Combining the results
+# -----------------------------------------------------------
+
+def outcome_counts(output):
+    # Reads the counters off pytest's final summary line
+    counts = {}
+    lines = [line for line in output.splitlines() if SUMMARY_PATTERN.match(line)]
+    if not lines:
+        return counts
+    for number, outcome in OUTCOME_PATTERN.findall(lines[-1]):
+        if not outcome.endswith('s') and outcome + 's' in OUTCOMES:
+            outcome += 's'
+        counts[outcome] = counts.get(outcome, 0) + int(number)
+    return counts
+
+
+def summary_line(outputs, seconds):
+    totals = {}
+    for output in outputs:
+        for outcome, number in outcome_counts(output).items():
+            totals[outcome] = totals.get(outcome, 0) + number
+    parts = [f'{totals[outcome]} {outcome}' for outcome in OUTCOMES if totals.get(outcome)]
+    summary = ', '.join(parts) or 'no tests ran'
+    summary += f' in {seconds:.2f}s across {len(outputs)} workers'
+    return f' {summary} '.center(70, '=')
+
+
+def combine_test_output(shards, outputs, seconds):
+    if len(outputs) == 1:
+        return outputs[0]
+    result = ''
+    for i, (files, output) in enumerate(zip(shards, outputs), start=1):
+        result += f' worker {i}: {" ".join(files)} '.center(70, '#') + '\n'
+        result += output.rstrip() + '\n\n'
+    result += summary_line(outputs, seconds) + '\n'
+    return result
+
+
+def tests_status(statuses):
+    # Any failing worker fails the lot; an empty one is of no interest
+    failed = [s for s in statuses if s not in (0, NO_TESTS_COLLECTED)]
+    if failed:
+        return failed[0]
+    return statuses[0] if statuses and all(statuses) else 0
+
+
+def report_coverage():
+    subprocess.run([sys.executable, '-m', 'coverage', 'combine'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                   env=environment())
+    completed = subprocess.run([sys.executable, '-m', 'coverage', 'report'],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True, env=environment())
+    return completed.returncode, completed.stdout
+
+
+def run(workers=None, lint=True, out=None):
+    out = out or sys.stdout
+    started = time.time()
+    testpaths, patterns = read_pytest_ini()
+    lint_jobs, workers = split_cores(os.cpu_count() or 1, workers, lint)
+    shards = shard(find_test_files(testpaths, patterns), workers)
+    remove_coverage_data()
+
+    # Kick off the linter and all the test workers at once
+    with open(LINT_FILE, 'w') as lint_output:
+        lint_process = start_lint(lint_output, lint_jobs) if lint else None
+        outputs = [tempfile.TemporaryFile('w+') for _ in shards]
+        processes = [start_shard(number, files, output)
+                     for number, (files, output) in enumerate(zip(shards, outputs), start=1)]
+        statuses = [process.wait() for process in processes]
+        seconds = time.time() - started
+        lint_status = lint_process.wait() if lint_process else 0
+    texts = []
+    for output in outputs:
+        output.seek(0)
+        texts.append(output.read())
+        output.close()
+
+    with open(TEST_FILE, 'w') as file:
+        file.write(combine_test_output(shards, texts, seconds))
+    coverage_status, coverage_text = report_coverage()
+    with open(COVERAGE_FILE, 'w') as file:
+        file.write(coverage_text)
+
+    # Echo everything to the build log, as the buildspecs used to do
+    for name in [LINT_FILE, TEST_FILE, COVERAGE_FILE]:
+        with open(name) as file:
+            out.write(file.read())
+
+    return tests_status(statuses) or lint_status or coverage_status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the linter, the tests and coverage side by side.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Test worker processes. Defaults to the cores the linter '
+                        'leaves over, half of them unless --no-lint is given.')
+    parser.add_argument('--no-lint', dest='lint', action='store_false',
+                        help=f'Skip the linter and leave {LINT_FILE} empty.')
+    args = parser.parse_args(argv)
+    return run(workers=args.workers, lint=args.lint)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
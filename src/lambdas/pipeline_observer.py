@@ -22,6 +22,7 @@ JOB_MARKER = 'AJOB'
 log.getLogger().setLevel(log.INFO)
 sns_client = boto3.client('sns')
 codepipeline_client = boto3.client('codepipeline')
+codebuild_client = boto3.client('codebuild')
 dynamodb = boto3.resource('dynamodb')
 job_table = dynamodb.Table(JOB_TABLE_NAME)
 s3 = boto3.resource('s3')
@@ -97,24 +98,38 @@ def send_report(pipeline, exec_id, state):
     # Git revision data
     revs = data['exec']['pipelineExecution']['artifactRevisions'][0]
     commit_id = revs['revisionId']
-    commit_msg = revs['revisionSummary']
-    commit_url = revs['revisionUrl']
+    # Promoted releases come from S3, without a summary or a URL
+    commit_msg = revs.get('revisionSummary') or 'Promoted release'
+    commit_url = revs.get('revisionUrl') or ''
     # The Test action
     test_actions = data['action_executions']['actionExecutionDetails']
     test_action = next((x for x in test_actions if x['actionName'] == TEST_ACTION_NAME),
                        None)
-    # The artifact
-    artifacts = test_action['output']['outputArtifacts'][0]
-    artifact_bucket = artifacts['s3location']['bucket']
-    artifact_key = artifacts['s3location']['key']
-    tests = get_test_results(artifact_bucket, artifact_key)
+    # Build phases and artifact sizes for each action
+    metrics = get_action_metrics(test_actions)
+    if test_action:
+        # The artifact
+        artifacts = test_action['output']['outputArtifacts'][0]
+        artifact_bucket = artifacts['s3location']['bucket']
+        artifact_key = artifacts['s3location']['key']
+        tests = get_test_results(artifact_bucket, artifact_key)
+    else:
+        # Promoted releases were tested by the pipeline they came from
+        tests = dict.fromkeys([LINT_FILE, TEST_FILE, COVERAGE_FILE],
+                              'Not run: the release was tested before it was promoted.')
    # Get the sorted stages
     stages = get_job_stages(exec_id)
-    # Start building the output string
     source_desc = source_string(commit_id, commit_msg, commit_url)
+
+    # Send the SNS message
+    publish(format_report(state, source_desc, stages, metrics, tests))
+
+
+def format_report(state, source_desc, stages, metrics, tests):
+    # Start building the output string
     result = f"{state}: {source_desc}\r\n\r\n"
 
-    result += format_stages(stages)
+    result += format_stages(stages, metrics)
 
     result += "\r\nLint:\r\n"
     result += f"\r\n{tests[LINT_FILE]}\r\n"
@@ -124,12 +139,11 @@ def send_report(pipeline, exec_id, state):
 
     result += "\r\nCoverage:\r\n"
     result += f"\r\n{tests[COVERAGE_FILE]}\r\n"
-
-    # Send the SNS message
-    publish(result)
+    return result
 
 
-def format_stages(stages):
+def format_stages(stages, metrics=None):
+    metrics = metrics or {}
     result = ''
     # Process each stage in order, giving the first one special treatment
     for stage in stages:
@@ -148,11 +162,38 @@ def format_stages(stages):
         else:
             result += f"    {stage['action']} {stage['state'].lower()} "
             result += f"after {human_time(started, ended)}\r\n"
+            result += format_metrics(metrics.get(stage['action']))
+    return result
+
+
+def format_metrics(metrics):
+    if not metrics:
+        return ''
+    result = ''
+    phases = metrics.get('phases')
+    if phases:
+        names = [f"{phase_name(name)} {seconds}s" for name, seconds in phases if seconds]
+        if names:
+            result += f"        Phases: {', '.join(names)}\r\n"
+        total = sum(seconds for _, seconds in phases)
+        name, seconds = max(phases, key=lambda x: x[1])
+        if total:
+            result += f"        Dominant phase: {phase_name(name)} "
+            result += f"({round(100 * seconds / total)}%)\r\n"
+    inputs = metrics.get('inputs') or []
+    outputs = metrics.get('outputs') or []
+    if inputs or outputs:
+        sizes = [f"in {human_size(size)}" for size in inputs]
+        sizes += [f"out {human_size(size)}" for size in outputs]
+        result += f"        Artifacts: {', '.join(sizes)}\r\n"
     return result
 
 
-def get_test_results(artifact_bucket, artifact_key):
-    base_dir = '/tmp'
+def phase_name(phase_type):
+    return phase_type.lower().replace('_', ' ')
+
+
+def get_test_results(artifact_bucket, artifact_key, base_dir='/tmp'):
     archive_path = f'{base_dir}/archive.zip'
     files = f'{base_dir}/extracted/'
     lint_file = f'{files}{LINT_FILE}'
@@ -196,6 +237,73 @@ def get_test_results(artifact_bucket, artifact_key):
     return result
 
 
+def get_action_metrics(action_executions):
+    # Only the latest execution of each action is of interest
+    latest = {}
+    for action in action_executions:
+        name = action['actionName']
+        started = action.get('startTime')
+        if name not in latest or \
+                (started and started > latest[name].get('startTime', started)):
+            latest[name] = action
+
+    builds = get_builds([build_id(action) for action in latest.values()
+                         if build_id(action)])
+    sizes = {}
+    result = {}
+    for name, action in latest.items():
+        build = builds.get(build_id(action)) or {}
+        result[name] = {
+            'phases': [(phase['phaseType'], phase['durationInSeconds'])
+                       for phase in build.get('phases', [])
+                       if 'durationInSeconds' in phase],
+            'inputs': artifact_sizes(
+                action.get('input', {}).get('inputArtifacts', []), sizes),
+            'outputs': artifact_sizes(
+                action.get('output', {}).get('outputArtifacts', []), sizes),
+        }
+    return result
+
+
+def build_id(action):
+    # CodeBuild actions record the id of their build
+    if action.get('input', {}).get('actionTypeId', {}).get('provider') != 'CodeBuild':
+        return None
+    return action.get('output', {}).get('executionResult', {}).get('externalExecutionId')
+
+
+def get_builds(build_ids):
+    # A single batched lookup covers all the builds of an execution
+    builds = {}
+    for i in range(0, len(build_ids), 100):
+        try:
+            response = codebuild_client.batch_get_builds(ids=build_ids[i:i + 100])
+        except Exception as e:
+            log.warning(f'Could not get the builds: {e}')
+            continue
+        for build in response.get('builds', []):
+            builds[build['id']] = build
+    return builds
+
+
+def artifact_sizes(artifacts, sizes):
+    # Artifacts are often shared between actions, so sizes are memoised
+    result = []
+    for artifact in artifacts:
+        location = artifact.get('s3location')
+        if not location:
+            continue
+        key = (location['bucket'], location['key'])
+        if key not in sizes:
+            try:
+                sizes[key] = s3.Object(*key).content_length
+            except Exception:
+                sizes[key] = None
+        if sizes[key] is not None:
+            result.append(sizes[key])
+    return result
+
+
 def get_job_stages(exec_id):
     # Get all job stages and sort them
     response = job_table.query(
@@ -265,5 +373,13 @@ def human_time(started, ended):
     return result.rstrip()
 
 
+def human_size(size):
+    for unit in ['bytes', 'KB', 'MB']:
+        if size < 1024:
+            return f'{size} {unit}' if unit == 'bytes' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
 def source_string(commit_id, commit_summary, commit_url):
     return f'[{commit_id[:8]}] {textwrap.shorten(commit_summary, width=50)}\r\n{commit_url}'
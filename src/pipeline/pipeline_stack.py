@@ -19,21 +19,40 @@ LINT_FILE = 'pylint.out'
 TEST_FILE = 'pytest.out'
 COVERAGE_FILE = 'coverage.out'
 
+# The CDK CLI installed from package-lock.json. Synthesis and every
+# deployment use it, so the release bundles the very CLI that deployed it.
+# It is run through node, as CodeBuild's zip artifacts don't keep the
+# node_modules/.bin symlinks.
+CDK_CLI = 'node node_modules/aws-cdk/bin/cdk'
+
 
 class PipelineStack(core.Stack):
 
     def __init__(self, scope: core.Construct, id: str,
                  project_name, stage,
-                 git_repo, git_branch,
-                 service_stacks,
+                 git_repo=None, git_branch=None,
+                 service_stacks=[],
                  build_timeout=15,
                  test_timeout=15,
                  deploy_timeout=15,
                  sns_emails=[],
                  sns_topic=None,
+                 promote_to=None,
+                 promoted=False,
+                 release_bucket=None,
+                 approve_promotion=True,
                  **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
+        # A promoted pipeline takes its source from the earlier pipeline's
+        # releases, so it needs their bucket, but no repo
+        if promoted and not release_bucket:
+            raise ValueError('A promoted pipeline needs the release_bucket '
+                             'of the pipeline promoting to it.')
+        if not promoted and not (git_repo and git_branch):
+            raise ValueError('A pipeline needs a git_repo and a git_branch '
+                             'unless it is promoted.')
+
         if sns_emails:
             # Create an SNS topic internal to the pipeline
             internal_sns_topic = sns.Topic(self, 'InternalTopic')
@@ -56,154 +75,204 @@ class PipelineStack(core.Stack):
             restart_execution_on_update=True,
         )
 
-        # The Source stage - getting the source from the repo
-        the_repo = codecommit.Repository.from_repository_name(
-            self, 'Repo', git_repo)
-
-        source_output = codepipeline.Artifact()
+        # The name of the action whose output the observer reports on
+        test_action_name = 'Test'
 
-        source_action = codepipeline_actions.CodeCommitSourceAction(
-            action_name='CodeCommit',
-            repository=the_repo,
-            output=source_output,
-            branch=git_branch,
-            trigger=codepipeline_actions.CodeCommitTrigger.EVENTS,
-        )
+        # Every CodeBuild project, so the observer can look up their builds
+        build_projects = []
+
+        # Releases are handed on from one pipeline to the next through a
+        # versioned bucket, created by the first pipeline and shared with
+        # those it promotes to
+        if promote_to or promoted:
+            self.release_bucket = release_bucket or \
+                s3.Bucket(self, 'Releases', versioned=True)
+
+        if promoted:
+            # The Source stage - getting the release promoted from the
+            # earlier pipeline. There is nothing to install, test or build:
+            # the release holds the very cloud assembly and dependencies
+            # the earlier pipeline tested and deployed.
+            source_output = codepipeline.Artifact('Release')
+
+            source_action = codepipeline_actions.S3SourceAction(
+                action_name='Release',
+                bucket=self.release_bucket,
+                bucket_key=f'releases/{stage}/release.zip',
+                output=source_output,
+            )
 
-        pipeline.add_stage(
-            stage_name='Source',
-            actions=[source_action],
-        )
+            pipeline.add_stage(
+                stage_name='Source',
+                actions=[source_action],
+            )
 
-        the_source = codebuild.Source.code_commit(
-            repository=the_repo,
-            clone_depth=1,
-        )
+            # Each deployment first checks the release is the one published
+            deploy_input = source_output
+            deploy_extra_inputs = []
+            deploy_setup = [
+                'sha256sum -c SHA256SUMS',
+                'mkdir -p assembly',
+                'tar xzf assembly.tar.gz -C assembly',
+                'tar xzf dependencies.tar.gz',
+            ]
+            cdk = f'{CDK_CLI} --app assembly'
+
+        else:
+            # The Source stage - getting the source from the repo
+            the_repo = codecommit.Repository.from_repository_name(
+                self, 'Repo', git_repo)
+
+            source_output = codepipeline.Artifact()
+
+            source_action = codepipeline_actions.CodeCommitSourceAction(
+                action_name='CodeCommit',
+                repository=the_repo,
+                output=source_output,
+                branch=git_branch,
+                trigger=codepipeline_actions.CodeCommitTrigger.EVENTS,
+            )
 
-        # The cache bucket
-        cache_bucket = s3.Bucket(self, 'Cache')
+            pipeline.add_stage(
+                stage_name='Source',
+                actions=[source_action],
+            )
 
-        # The Install stage - installing CDK and requirements
-        install_project = codebuild.Project(
-            self, f'Install_{stage}',
-            project_name=f'{pipeline_name}_install',
-            timeout=core.Duration.minutes(build_timeout),
-            environment={
-                'build_image': codebuild.LinuxBuildImage.UBUNTU_14_04_NODEJS_10_14_1
-            },
-            source=the_source,
-            cache=codebuild.Cache.bucket(cache_bucket),
-            build_spec=codebuild.BuildSpec.from_object({
-                'version': 0.2,
-                'phases': {
-                    'build': {
-                        'commands': [
-                            'ls -la',
-                            'python3 -m venv .env',
-                            '. .env/bin/activate',
-                            'npm config -g set prefer-offline true',
-                            'npm config -g set cache /root/.npm',
-                            'npm config get cache',
-                            'npm ci',
-                            'pip install -r requirements.txt',
-                            'pip wheel --wheel-dir=wheels -r requirements.txt',
-                            'ls -la',
-                        ]
-                    },
-                },
-                'artifacts': {
-                    'files': [
-                        '**/*'
-                    ],
-                },
-                'cache': {
-                    'paths': [
-                        '/root/.npm/**/*',
-                        '/root/.cache/pip/**/*',
-                        'wheels/**/*',
-                    ],
-                },
-            }),
-        )
-        install_output = codepipeline.Artifact()
-        install_action = codepipeline_actions.CodeBuildAction(
-            action_name='Dependencies',
-            project=install_project,
-            input=source_output,
-            outputs=[install_output],
-        )
-        pipeline.add_stage(
-            stage_name='Install',
-            actions=[install_action],
-        )
+            the_source = codebuild.Source.code_commit(
+                repository=the_repo,
+                clone_depth=1,
+            )
 
-        # The Unit Test action, before synthesis
-        test_action_name = 'Test'
-        test_output = codepipeline.Artifact()
-        test_project = codebuild.Project(
-            self, f'Test_{stage}',
-            project_name=f'{pipeline_name}_test',
-            timeout=core.Duration.minutes(test_timeout),
-            environment={
-                'build_image': codebuild.LinuxBuildImage.UBUNTU_14_04_NODEJS_10_14_1
-            },
-            source=the_source,
-            cache=codebuild.Cache.bucket(s3.Bucket(self, 'Test')),
-            build_spec=codebuild.BuildSpec.from_source_filename(
-                f'buildspec.{stage}.test.yml'),
-        )
-        test_action = codepipeline_actions.CodeBuildAction(
-            action_name=test_action_name,
-            type=codepipeline_actions.CodeBuildActionType.TEST,
-            project=test_project,
-            input=install_output,
-            outputs=[test_output]
-        )
+            # The cache bucket
+            cache_bucket = s3.Bucket(self, 'Cache')
 
-        # The Build action - producing the artifacts needed to deploy
-        build_project = codebuild.Project(
-            self, f'Build_{stage}',
-            project_name=f'{pipeline_name}_build',
-            timeout=core.Duration.minutes(build_timeout),
-            environment={
-                'build_image': codebuild.LinuxBuildImage.UBUNTU_14_04_NODEJS_10_14_1
-            },
-            source=the_source,
-            build_spec=codebuild.BuildSpec.from_object({
-                'version': 0.2,
-                'phases': {
-                    'build': {
-                        'commands': [
-                            'ls -la',
-                            '. .env/bin/activate',
-                            'npm link aws-cdk --silent',
-                            'pip install -q --no-index --find-links=wheels -r requirements.txt',
-                            'cdk synth -o ./dist',
-                            'ls -la ./dist',
-                        ]
+            # The Install stage - installing CDK and requirements
+            install_project = codebuild.Project(
+                self, f'Install_{stage}',
+                project_name=f'{pipeline_name}_install',
+                timeout=core.Duration.minutes(build_timeout),
+                environment={
+                    'build_image': codebuild.LinuxBuildImage.UBUNTU_14_04_NODEJS_10_14_1
+                },
+                source=the_source,
+                cache=codebuild.Cache.bucket(cache_bucket),
+                build_spec=codebuild.BuildSpec.from_object({
+                    'version': 0.2,
+                    'phases': {
+                        'build': {
+                            'commands': [
+                                'ls -la',
+                                'python3 -m venv .env',
+                                '. .env/bin/activate',
+                                'npm config -g set prefer-offline true',
+                                'npm config -g set cache /root/.npm',
+                                'npm config get cache',
+                                'npm ci',
+                                'pip install -r requirements.txt',
+                                'pip wheel --wheel-dir=wheels -r requirements.txt',
+                                'ls -la',
+                            ]
+                        },
+                    },
+                    'artifacts': {
+                        'files': [
+                            '**/*'
+                        ],
                     },
+                    'cache': {
+                        'paths': [
+                            '/root/.npm/**/*',
+                            '/root/.cache/pip/**/*',
+                            'wheels/**/*',
+                        ],
+                    },
+                }),
+            )
+            install_output = codepipeline.Artifact()
+            install_action = codepipeline_actions.CodeBuildAction(
+                action_name='Dependencies',
+                project=install_project,
+                input=source_output,
+                outputs=[install_output],
+            )
+            pipeline.add_stage(
+                stage_name='Install',
+                actions=[install_action],
+            )
+
+            # The Unit Test action, before synthesis
+            test_output = codepipeline.Artifact()
+            test_project = codebuild.Project(
+                self, f'Test_{stage}',
+                project_name=f'{pipeline_name}_test',
+                timeout=core.Duration.minutes(test_timeout),
+                environment={
+                    'build_image': codebuild.LinuxBuildImage.UBUNTU_14_04_NODEJS_10_14_1
                 },
-                'artifacts': {
-                    'files': [
-                        '**/*'
-                    ],
-                    'base-directory': 'dist',
+                source=the_source,
+                cache=codebuild.Cache.bucket(s3.Bucket(self, 'Test')),
+                build_spec=codebuild.BuildSpec.from_source_filename(
+                    f'buildspec.{stage}.test.yml'),
+            )
+            test_action = codepipeline_actions.CodeBuildAction(
+                action_name=test_action_name,
+                type=codepipeline_actions.CodeBuildActionType.TEST,
+                project=test_project,
+                input=install_output,
+                outputs=[test_output]
+            )
+
+            # The Build action - producing the artifacts needed to deploy
+            build_project = codebuild.Project(
+                self, f'Build_{stage}',
+                project_name=f'{pipeline_name}_build',
+                timeout=core.Duration.minutes(build_timeout),
+                environment={
+                    'build_image': codebuild.LinuxBuildImage.UBUNTU_14_04_NODEJS_10_14_1
                 },
-            })
-        )
-        build_output = codepipeline.Artifact()
-        build_action = codepipeline_actions.CodeBuildAction(
-            action_name='Build',
-            project=build_project,
-            input=install_output,
-            outputs=[build_output]
-        )
+                source=the_source,
+                build_spec=codebuild.BuildSpec.from_object({
+                    'version': 0.2,
+                    'phases': {
+                        'build': {
+                            'commands': [
+                                'ls -la',
+                                '. .env/bin/activate',
+                                'pip install -q --no-index --find-links=wheels -r requirements.txt',
+                                f'{CDK_CLI} synth -o ./dist',
+                                'ls -la ./dist',
+                            ]
+                        },
+                    },
+                    'artifacts': {
+                        'files': [
+                            '**/*'
+                        ],
+                        'base-directory': 'dist',
+                    },
+                })
+            )
+            build_output = codepipeline.Artifact('Build')
+            build_action = codepipeline_actions.CodeBuildAction(
+                action_name='Build',
+                project=build_project,
+                input=install_output,
+                outputs=[build_output]
+            )
 
-        # A stage which runs Unit Tests and the Build in parallel
-        pipeline.add_stage(
-            stage_name='TestAndBuild',
-            actions=[test_action, build_action],
-        )
+            # A stage which runs Unit Tests and the Build in parallel
+            pipeline.add_stage(
+                stage_name='TestAndBuild',
+                actions=[test_action, build_action],
+            )
+            build_projects.extend([install_project, test_project, build_project])
+
+            # The deployments take the CLI from the installed dependencies
+            # and the cloud assembly from the Build
+            deploy_input = install_output
+            deploy_extra_inputs = [build_output]
+            deploy_setup = []
+            cdk = f'{CDK_CLI} --app "$CODEBUILD_SRC_DIR_Build"'
 
         # Deploy the pipeline itself. Very meta.
         deploy_pipeline_project = codebuild.Project(
@@ -218,13 +287,14 @@ class PipelineStack(core.Stack):
                 'phases': {
                     'build': {
                         'commands': [
-                            'npm link aws-cdk --silent',
-                            f'cdk --app . --require-approval=never deploy {id}',
+                            *deploy_setup,
+                            f'{cdk} --require-approval=never deploy {id}',
                         ]
                     },
                 },
             })
         )
+        build_projects.append(deploy_pipeline_project)
         deploy_pipeline_project.add_to_role_policy(
             iam.PolicyStatement(
                 resources=['*'],   # This needs tightening up
@@ -235,7 +305,8 @@ class PipelineStack(core.Stack):
         deploy_pipeline_action = codepipeline_actions.CodeBuildAction(
             action_name=id,
             project=deploy_pipeline_project,
-            input=build_output,
+            input=deploy_input,
+            extra_inputs=deploy_extra_inputs,
         )
         # Create the pipeline deployment stage
         pipeline.add_stage(
@@ -259,8 +330,8 @@ class PipelineStack(core.Stack):
                     'phases': {
                         'build': {
                             'commands': [
-                                'npm link aws-cdk --silent',
-                                f'cdk --app . --require-approval=never deploy {stack}',
+                                *deploy_setup,
+                                f'{cdk} --require-approval=never deploy {stack}',
                             ]
                         },
                     },
@@ -276,11 +347,13 @@ class PipelineStack(core.Stack):
             deploy_action = codepipeline_actions.CodeBuildAction(
                 action_name=stack,
                 project=deploy_project,
-                input=build_output,
+                input=deploy_input,
+                extra_inputs=deploy_extra_inputs,
             )
 
             # Add the action to the list of deployments to be executed in parallel
             deploy_actions.append(deploy_action)
+            build_projects.append(deploy_project)
 
         # Create the workload deployment stage
         pipeline.add_stage(
@@ -288,6 +361,76 @@ class PipelineStack(core.Stack):
             actions=deploy_actions,
         )
 
+        # The Promote stage - handing what was just deployed on to the
+        # next pipeline, which will deploy it without building it again
+        if promote_to:
+            promote_actions = []
+            if promoted:
+                # Pass on the release exactly as it was received
+                release_output = source_output
+            else:
+                # Package the cloud assembly and the dependencies needed to
+                # deploy it, with checksums for the next pipeline to verify
+                package_project = codebuild.Project(
+                    self, 'Package',
+                    project_name=f'{pipeline_name}_package',
+                    timeout=core.Duration.minutes(build_timeout),
+                    environment={
+                        'build_image': codebuild.LinuxBuildImage.UBUNTU_14_04_NODEJS_10_14_1
+                    },
+                    build_spec=codebuild.BuildSpec.from_object({
+                        'version': 0.2,
+                        'phases': {
+                            'build': {
+                                'commands': [
+                                    'mkdir -p release',
+                                    'tar czf release/dependencies.tar.gz node_modules',
+                                    'tar czf release/assembly.tar.gz -C "$CODEBUILD_SRC_DIR_Build" .',
+                                    '(cd release && sha256sum *.tar.gz > SHA256SUMS)',
+                                    'cat release/SHA256SUMS',
+                                ]
+                            },
+                        },
+                        'artifacts': {
+                            'files': [
+                                '**/*'
+                            ],
+                            'base-directory': 'release',
+                        },
+                    })
+                )
+                build_projects.append(package_project)
+                release_output = codepipeline.Artifact('Release')
+                promote_actions.append(codepipeline_actions.CodeBuildAction(
+                    action_name='Package',
+                    project=package_project,
+                    input=install_output,
+                    extra_inputs=[build_output],
+                    outputs=[release_output],
+                    run_order=1,
+                ))
+            # Releasing to the next environment waits for someone to
+            # approve it, unless the pipeline was told otherwise
+            if approve_promotion:
+                promote_actions.append(codepipeline_actions.ManualApprovalAction(
+                    action_name='Approve',
+                    notification_topic=self.sns_topic if sns_emails else None,
+                    additional_information=f'Promote this release to {promote_to}.',
+                    run_order=2,
+                ))
+            promote_actions.append(codepipeline_actions.S3DeployAction(
+                action_name=promote_to,
+                bucket=self.release_bucket,
+                input=release_output,
+                extract=False,
+                object_key=f'releases/{promote_to}/release.zip',
+                run_order=3,
+            ))
+            pipeline.add_stage(
+                stage_name='Promote',
+                actions=promote_actions,
+            )
+
         # -----------------------------------------------------------
         # The rest of this file is conditional. If the list of email
         # recipients is non-empty, a Lambda and a small DynamoDB will
@@ -380,6 +523,14 @@ class PipelineStack(core.Stack):
                 )
             )
 
+            # To break down the time spent by each build into its phases
+            pipeline_observer.add_to_role_policy(
+                iam.PolicyStatement(
+                    resources=[project.project_arn for project in build_projects],
+                    actions=['codebuild:BatchGetBuilds'],
+                )
+            )
+
             internal_sns_topic.add_subscription(
                 sns_subscriptions.LambdaSubscription(pipeline_observer)
             )
@@ -0,0 +1,109 @@
+import io
+
+from ci import lint
+
+
+def make_result(path, statement, **counts):
+    stats = dict.fromkeys(lint.STAT_NAMES, 0)
+    stats.update(counts, statement=statement)
+    messages = [{
+        'module': path[:-3],
+        'path': path,
+        'line': 1,
+        'column': 0,
+        'msg_id': 'C0114',
+        'symbol': 'missing-module-docstring',
+        'msg': 'Missing module docstring',
+    }] if counts.get('convention') else []
+    return {'path': path, 'messages': messages, 'stats': stats}
+
+
+def test_find_python_files_honours_ignore(tmp_path):
+    for path in ['app.py', 'src/a.py', 'node_modules/x.py', '.env/y.py', 'src/b.txt']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+    found = lint.find_python_files(str(tmp_path), {'node_modules', '.env'})
+    assert found == ['app.py', 'src/a.py']
+
+
+def test_score_matches_pylint_evaluation():
+    totals = lint.total_stats([
+        make_result('a.py', 10, convention=1),
+        make_result('b.py', 10, error=1),
+    ])
+    assert totals['statement'] == 20
+    assert lint.score(totals) == 10.0 - (6 / 20) * 10
+    assert lint.exit_status(totals) == 2 | 16
+
+
+def test_cached_files_are_not_relinted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'pylintrc').write_text('[MASTER]\nignore=CVS\n')
+    (tmp_path / 'a.py').write_text('A = 1\n')
+    (tmp_path / 'b.py').write_text('B = 2\n')
+    cache_dir = str(tmp_path / 'cache')
+    rc_hash = lint.hash_file('pylintrc')
+    version = lint.pylint_version()
+    for path in ['a.py', 'b.py']:
+        lint.store_cached(cache_dir, lint.cache_key(path, rc_hash, version),
+                          make_result(path, 1))
+    lint.store_cached(cache_dir, 'obsolete', make_result('gone.py', 1))
+
+    linted = []
+    monkeypatch.setattr(lint, 'lint_files',
+                        lambda paths, *_: linted.extend(paths) or [])
+    out = io.StringIO()
+    status = lint.run(cache_dir=cache_dir,
+                      score_file=str(tmp_path / 'score.json'), out=out)
+
+    assert status == 0
+    assert not linted
+    assert 'Your code has been rated at 10.00/10' in out.getvalue()
+    assert lint.load_cached(cache_dir, 'obsolete') is None
+
+
+def test_changed_file_is_relinted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a.py').write_text('A = 1\n')
+    cache_dir = str(tmp_path / 'cache')
+    key = lint.cache_key('a.py', '', lint.pylint_version())
+    lint.store_cached(cache_dir, key, make_result('a.py', 1))
+    (tmp_path / 'a.py').write_text('A = 2\n')
+
+    monkeypatch.setattr(lint, 'lint_files',
+                        lambda paths, *_: [make_result(p, 1, convention=1) for p in paths])
+    out = io.StringIO()
+    lint.run(cache_dir=cache_dir, score_file=str(tmp_path / 'score.json'), out=out)
+
+    assert '************* Module a\na.py:1:0: C0114' in out.getvalue()
+    assert 'Your code has been rated at 0.00/10' in out.getvalue()
+
+
+def test_score_can_be_negative():
+    totals = lint.total_stats([make_result('a.py', 1, convention=3, error=1)])
+    assert lint.score(totals) == 10.0 - (8 / 1) * 10 == -70.0
+
+
+def test_changed_import_changes_the_key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'src' / 'pkg').mkdir(parents=True)
+    (tmp_path / 'app.py').write_text('from pkg import helpers\n')
+    (tmp_path / 'src' / 'pkg' / 'helpers.py').write_text('from . import base\n')
+    (tmp_path / 'src' / 'pkg' / 'base.py').write_text('VALUE = 1\n')
+    assert lint.project_imports('app.py') == ['src/pkg/base.py', 'src/pkg/helpers.py']
+
+    key = lint.cache_key('app.py', '', 'x')
+    (tmp_path / 'src' / 'pkg' / 'base.py').write_text('OTHER = 1\n')
+    assert lint.cache_key('app.py', '', 'x') != key
+
+
+def test_partial_run_does_not_store_the_score(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a.py').write_text('A = 1\n')
+    monkeypatch.setattr(lint, 'lint_files', lambda paths, *_: [make_result(p, 1) for p in paths])
+    score_file = tmp_path / 'score.json'
+    lint.run(['a.py'], cache_dir=str(tmp_path / 'cache'), score_file=str(score_file),
+             out=io.StringIO())
+    assert not score_file.exists()
+    lint.run(cache_dir=str(tmp_path / 'cache'), score_file=str(score_file), out=io.StringIO())
+    assert lint.load_previous_score(str(score_file)) == 10.0
@@ -0,0 +1,188 @@
+import os
+import json
+import logging
+import subprocess
+
+import pytest
+
+from ci import local_pipeline
+
+
+def project(commands, artifacts=None):
+    spec = {'version': 0.2, 'phases': {'build': {'commands': commands}}}
+    if artifacts:
+        spec['artifacts'] = artifacts
+    return {'Type': 'AWS::CodeBuild::Project',
+            'Properties': {'Source': {'BuildSpec': json.dumps(spec)}}}
+
+
+def action(name, category, provider, project_id=None, inputs=(), outputs=(), run_order=1):
+    result = {
+        'Name': name,
+        'ActionTypeId': {'Category': category, 'Provider': provider},
+        'InputArtifacts': [{'Name': n} for n in inputs],
+        'OutputArtifacts': [{'Name': n} for n in outputs],
+        'RunOrder': run_order,
+    }
+    if project_id:
+        result['Configuration'] = {'ProjectName': {'Ref': project_id}}
+    return result
+
+
+TEMPLATE = {'Resources': {
+    'Install': project(['echo deps > deps.txt'], {'files': ['**/*']}),
+    'Test': project(['cat deps.txt > pytest.out', 'cat app.txt >> pytest.out'],
+                    {'files': ['pytest.out']}),
+    'Build': project(['mkdir dist', 'cp app.txt dist/assembly.txt'],
+                     {'files': ['**/*'], 'base-directory': 'dist'}),
+    'Package': project(['cp "$CODEBUILD_SRC_DIR_Build/assembly.txt" release.txt'],
+                       {'files': ['release.txt']}),
+    'Deploy': project(['cdk --app . --require-approval=never deploy app-dev']),
+    'Pipeline': {'Type': 'AWS::CodePipeline::Pipeline', 'Properties': {'Stages': [
+        {'Name': 'Source', 'Actions': [
+            action('CodeCommit', 'Source', 'CodeCommit', outputs=['Source'])]},
+        {'Name': 'Install', 'Actions': [
+            action('Dependencies', 'Build', 'CodeBuild', 'Install', ['Source'], ['Installed'])]},
+        {'Name': 'TestAndBuild', 'Actions': [
+            action('Test', 'Test', 'CodeBuild', 'Test', ['Installed'], ['Tested']),
+            action('Build', 'Build', 'CodeBuild', 'Build', ['Installed'], ['Build'])]},
+        {'Name': 'DeployWorkload', 'Actions': [
+            action('app-dev', 'Build', 'CodeBuild', 'Deploy', ['Build'])]},
+        {'Name': 'Promote', 'Actions': [
+            action('Package', 'Build', 'CodeBuild', 'Package', ['Installed', 'Build'],
+                   ['Release'], run_order=1),
+            action('staging', 'Deploy', 'S3', inputs=['Release'], run_order=2)]},
+    ]}},
+}}
+
+
+def make_repo(path, monkeypatch):
+    monkeypatch.chdir(path)
+    subprocess.run(['git', 'init', '-q'], check=True)
+    (path / 'app.txt').write_text('app\n')
+    (path / '.gitignore').write_text('.local-pipeline/\n')
+
+
+def test_layout_follows_the_template():
+    layout = local_pipeline.pipeline_layout(TEMPLATE)
+    assert [stage['name'] for stage in layout] == \
+        ['Source', 'Install', 'TestAndBuild', 'DeployWorkload', 'Promote']
+    test, build = layout[2]['actions']
+    assert test['inputs'] == ['Installed'] and build['outputs'] == ['Build']
+    assert 'BuildSpec' in test['project']['Source']
+
+
+def test_deployments_become_diffs():
+    assert local_pipeline.as_diff('cdk --app . --require-approval=never deploy app-dev') == \
+        'cdk --app . diff app-dev'
+    assert local_pipeline.as_diff('echo deploy') == 'echo deploy'
+    assert local_pipeline.as_diff('node_modules/.bin/cdk --profile deploy deploy deploy-api') \
+        == 'node_modules/.bin/cdk --profile deploy diff deploy-api'
+    assert local_pipeline.as_diff('cdk synth deploy') == 'cdk synth deploy'
+    assert local_pipeline.as_diff('npm link aws-cdk --silent') == 'npm link aws-cdk --silent'
+
+
+def test_pipeline_runs_locally(tmp_path, monkeypatch):
+    make_repo(tmp_path, monkeypatch)
+    layout = local_pipeline.pipeline_layout(TEMPLATE)
+    run = local_pipeline.run_pipeline(layout, diff=False)
+
+    assert run['state'] == 'SUCCEEDED'
+    states = {a['name']: a['state'] for stage in run['stages'] for a in stage['actions']}
+    assert states == {'CodeCommit': 'SUCCEEDED', 'Dependencies': 'SUCCEEDED',
+                      'Test': 'SUCCEEDED', 'Build': 'SUCCEEDED', 'app-dev': 'SKIPPED',
+                      'Package': 'SUCCEEDED', 'staging': 'SKIPPED'}
+    artifacts = tmp_path / '.local-pipeline' / 'artifacts'
+    assert (artifacts / 'Tested' / 'pytest.out').read_text() == 'deps\napp\n'
+    assert (artifacts / 'Release' / 'release.txt').read_text() == 'app\n'
+    test = run['stages'][2]['actions'][0]
+    assert [phase for phase, _ in test['phases']] == [
+        'DOWNLOAD_SOURCE', 'INSTALL', 'PRE_BUILD', 'BUILD', 'POST_BUILD', 'UPLOAD_ARTIFACTS']
+
+    records = local_pipeline.job_records(run)
+    assert records[0]['stage'] == 'AJOB'
+    test_record = [r for r in records if r['stage'] == 'TestAndBuild: Test'][0]
+    assert test_record['action'] == 'Test' and test_record['state'] == 'SUCCEEDED'
+
+
+def test_failing_action_stops_the_pipeline(tmp_path, monkeypatch):
+    make_repo(tmp_path, monkeypatch)
+    template = json.loads(json.dumps(TEMPLATE))
+    template['Resources']['Test'] = project(['false', 'echo not reached > pytest.out'])
+    run = local_pipeline.run_pipeline(local_pipeline.pipeline_layout(template), diff=False)
+    assert run['state'] == 'FAILED'
+    assert [stage['name'] for stage in run['stages']] == ['Source', 'Install', 'TestAndBuild']
+    assert not os.path.exists(tmp_path / '.local-pipeline' / 'artifacts' / 'Tested')
+
+
+def test_reused_stage_gets_the_current_source(tmp_path, monkeypatch):
+    make_repo(tmp_path, monkeypatch)
+    layout = local_pipeline.pipeline_layout(TEMPLATE)
+    local_pipeline.run_pipeline(layout, diff=False)
+    (tmp_path / 'app.txt').write_text('changed\n')
+    run = local_pipeline.run_pipeline(layout, diff=False, reuse=['Install'])
+    assert run['stages'][1]['actions'][0]['phases'] == []
+    tested = tmp_path / '.local-pipeline' / 'artifacts' / 'Tested' / 'pytest.out'
+    assert tested.read_text() == 'deps\nchanged\n'
+
+
+def test_actions_cannot_change_their_inputs(tmp_path, monkeypatch):
+    make_repo(tmp_path, monkeypatch)
+    template = json.loads(json.dumps(TEMPLATE))
+    template['Resources']['Test'] = project(['echo CLOBBERED > deps.txt'])
+    template['Resources']['Build'] = project(['sleep 0.2', 'cp deps.txt copy.txt'],
+                                             {'files': ['copy.txt']})
+    layout = local_pipeline.pipeline_layout(template)[:3]
+    assert local_pipeline.run_pipeline(layout, diff=False)['state'] == 'SUCCEEDED'
+    work_dir = tmp_path / '.local-pipeline'
+    assert (work_dir / 'artifacts' / 'Installed' / 'deps.txt').read_text() == 'deps\n'
+    assert (work_dir / 'work' / 'Install' / 'Dependencies' / 'deps.txt').read_text() == 'deps\n'
+    assert (work_dir / 'artifacts' / 'Build' / 'copy.txt').read_text() == 'deps\n'
+
+
+def test_actions_get_a_home_of_their_own(tmp_path, monkeypatch):
+    make_repo(tmp_path, monkeypatch)
+    monkeypatch.setenv('NPM_CONFIG_CACHE', '/somewhere/else')
+    template = json.loads(json.dumps(TEMPLATE))
+    template['Resources']['Install'] = project(
+        ['env | grep -i -e ^home= -e ^npm_config_ -e ^pip_cache_dir= -e ^path= > env.txt'],
+        {'files': ['env.txt']})
+    layout = local_pipeline.pipeline_layout(template)[:2]
+    assert local_pipeline.run_pipeline(layout, diff=False)['state'] == 'SUCCEEDED'
+    work_dir = tmp_path / '.local-pipeline'
+    env = dict(line.split('=', 1) for line in
+               (work_dir / 'artifacts' / 'Installed' / 'env.txt').read_text().splitlines())
+    assert env['HOME'] == str(work_dir / 'home' / 'Install' / 'Dependencies')
+    assert env['npm_config_globalconfig'].startswith(env['HOME'])
+    assert env['npm_config_cache'] == str(work_dir / 'cache' / 'npm')
+    assert env['PIP_CACHE_DIR'] == str(work_dir / 'cache' / 'pip')
+    assert env['npm_config_prefix'].startswith(env['HOME'])
+    assert 'NPM_CONFIG_CACHE' not in env
+    assert env['PATH'].startswith(env['npm_config_prefix'] + '/bin:')
+
+
+def test_report_leaves_the_environment_alone(tmp_path, monkeypatch):
+    pytest.importorskip('boto3')
+    make_repo(tmp_path, monkeypatch)
+    monkeypatch.delenv('JOB_TABLE_NAME', raising=False)
+    layout = local_pipeline.pipeline_layout(TEMPLATE)
+    run = local_pipeline.run_pipeline(layout, diff=False)
+    level = logging.getLogger().level
+    text = local_pipeline.report(run, layout, str(tmp_path / '.local-pipeline'),
+                                 {'TEST_ACTION_NAME': 'Test', 'TEST_FILE': 'pytest.out'})
+    assert 'Test succeeded' in text and 'deps\r\napp' in text.replace('\n', '\r\n')
+    assert 'JOB_TABLE_NAME' not in os.environ
+    assert logging.getLogger().level == level
+
+
+def test_source_leaves_out_what_runs_produce(tmp_path, monkeypatch):
+    make_repo(tmp_path, monkeypatch)
+    os.remove(tmp_path / '.gitignore')
+    for path in ['cdk.out/t.json', 'node_modules/foo/i.js', '.env/bin/python']:
+        (tmp_path / path).parent.mkdir(parents=True)
+        (tmp_path / path).write_text('')
+    layout = local_pipeline.pipeline_layout(TEMPLATE)[:2]
+    for _ in range(2):
+        assert local_pipeline.run_pipeline(layout, diff=False)['state'] == 'SUCCEEDED'
+    source = tmp_path / '.local-pipeline' / 'artifacts' / 'Source'
+    assert sorted(os.listdir(source)) == ['app.txt']
@@ -0,0 +1,63 @@
+import pytest
+
+from ci import observer_load
+
+
+def test_synthesized_execution_follows_the_pipeline_layout():
+    timeline = observer_load.synthesize(2, seed=1)
+    # Pipeline, 5 stages and 6 actions, each started and finished
+    assert len(timeline) == 2 * 2 * (1 + 5 + 6)
+    assert [at for at, _ in timeline] == sorted(at for at, _ in timeline)
+    records = observer_load.expected_records(timeline)
+    assert len(records) == 2 * 12
+    assert set(records.values()) == {'SUCCEEDED'}
+    exec_id = timeline[0][1]['detail']['execution-id']
+    assert (exec_id, 'AJOB') in records
+    assert (exec_id, 'TestAndBuild: Test') in records
+
+
+def test_disorder_delays_and_duplicates():
+    timeline = observer_load.synthesize(3, seed=1)
+    deliveries, counts = observer_load.disorder(timeline, delayed=0.5, duplicated=0.5, seed=2)
+    assert counts['delayed'] and counts['duplicated']
+    assert len(deliveries) == len(timeline) + counts['duplicated']
+    in_order, _ = observer_load.disorder(timeline, seed=2)
+    assert [event for _, _, event in in_order] == [event for _, event in timeline]
+
+
+def test_check_records_finds_lost_and_corrupted_records():
+    expected = {('e', 'AJOB'): 'SUCCEEDED', ('e', 'Install'): 'SUCCEEDED',
+                ('e', 'Source'): 'SUCCEEDED'}
+    items = {
+        ('e', 'AJOB'): {'state': 'SUCCEEDED', 'started': 't', 'ended': 't'},
+        # Overwritten by a late STARTED event
+        ('e', 'Install'): {'state': 'STARTED', 'started': 't'},
+    }
+    lost, corrupted = observer_load.check_records(items, expected)
+    assert lost == [('e', 'Source')]
+    assert corrupted == [('e', 'Install')]
+
+
+def test_check_reports_matches_reports_to_executions():
+    actions = {'abcdef12-0000': {'Test', 'Build'}, '12345678-0000': {'Test'}}
+    report = 'SUCCEEDED: [abcdef12] Load test\r\n\xa0\xa0\xa0 Test succeeded after 1 second\r\n'
+    missing, duplicates, incomplete = observer_load.check_reports([report, report], actions)
+    assert missing == ['12345678-0000']
+    assert duplicates == 1
+    assert incomplete == ['abcdef12-0000']
+
+
+def test_busy_time_counts_overlaps_once():
+    assert observer_load.busy_time([(0, 2), (1, 3), (5, 6), (5.5, 5.6)]) == 4
+    assert observer_load.busy_time([]) == 0
+
+
+def test_replay_of_orderly_events_produces_correct_reports():
+    pytest.importorskip('boto3')
+    observer = observer_load.load_observer()
+    timeline = observer_load.synthesize(2, seed=1)
+    result = observer_load.replay(observer, timeline, scale=0.005)
+    assert observer_load.healthy(result), observer_load.format_result(result)
+    # Delivered on the timeline's own schedule, not back to back
+    assert result['span'] == timeline[-1][0]
+    assert result['busy'] < result['span']
@@ -0,0 +1,125 @@
+import os
+import importlib.util
+
+import pytest
+
+pytest.importorskip('boto3')
+
+OBSERVER_PATH = os.path.join(os.path.dirname(__file__), '..', 'src', 'lambdas',
+                             'pipeline_observer.py')
+ARTIFACT_SIZE = 4096
+
+
+@pytest.fixture
+def observer(monkeypatch):
+    for name, value in {
+            'OUTPUT_SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:000000000000:test',
+            'JOB_TABLE_NAME': 'Jobs',
+            'TEST_ACTION_NAME': 'Test',
+            'LINT_FILE': 'pylint.out',
+            'TEST_FILE': 'pytest.out',
+            'COVERAGE_FILE': 'coverage.out',
+            'AWS_DEFAULT_REGION': 'us-east-1'}.items():
+        monkeypatch.setenv(name, value)
+    spec = importlib.util.spec_from_file_location('pipeline_observer', OBSERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def codebuild_action(name, build, inputs, outputs, started=1):
+    return {
+        'actionName': name,
+        'startTime': started,
+        'input': {
+            'actionTypeId': {'provider': 'CodeBuild'},
+            'inputArtifacts': [{'s3location': {'bucket': 'b', 'key': k}} for k in inputs],
+        },
+        'output': {
+            'executionResult': {'externalExecutionId': build},
+            'outputArtifacts': [{'s3location': {'bucket': 'b', 'key': k}} for k in outputs],
+        },
+    }
+
+
+class Builds:
+
+    def __init__(self):
+        self.calls = []
+
+    def batch_get_builds(self, ids):
+        self.calls.append(ids)
+        return {'builds': [{'id': i, 'phases': [
+            {'phaseType': 'PROVISIONING', 'durationInSeconds': 30},
+            {'phaseType': 'BUILD', 'durationInSeconds': 10},
+            {'phaseType': 'COMPLETED'},
+        ]} for i in ids]}
+
+
+class Object:
+
+    def __init__(self, bucket, key):
+        self.content_length = ARTIFACT_SIZE
+
+
+class S3:
+
+    def Object(self, bucket, key):   # pylint: disable=invalid-name
+        return Object(bucket, key)
+
+
+class SNS:
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message):
+        self.messages.append(Message)
+
+
+def test_action_metrics_are_fetched_in_one_batch(observer, monkeypatch):
+    builds = Builds()
+    monkeypatch.setattr(observer, 'codebuild_client', builds)
+    monkeypatch.setattr(observer, 's3', S3())
+    actions = [
+        codebuild_action('Test', 'test:2', ['x/in'], ['out'], started=2),
+        codebuild_action('Test', 'test:1', ['x/in'], ['out'], started=1),
+        codebuild_action('Build', 'build:1', ['x/in'], []),
+        {'actionName': 'CodeCommit', 'input': {'actionTypeId': {'provider': 'CodeCommit'}}},
+    ]
+    metrics = observer.get_action_metrics(actions)
+    assert builds.calls == [['test:2', 'build:1']]
+    assert metrics['Test']['phases'] == [('PROVISIONING', 30), ('BUILD', 10)]
+    assert metrics['Build']['inputs'] == [ARTIFACT_SIZE]
+    assert metrics['CodeCommit'] == {'phases': [], 'inputs': [], 'outputs': []}
+
+
+def test_format_metrics_flags_the_dominant_phase(observer):
+    result = observer.format_metrics({
+        'phases': [('QUEUED', 0), ('PROVISIONING', 30), ('BUILD', 10)],
+        'inputs': [2048],
+        'outputs': [5 * 1024 * 1024],
+    })
+    lines = [line.strip() for line in result.splitlines()]
+    assert lines == [
+        'Phases: provisioning 30s, build 10s',
+        'Dominant phase: provisioning (75%)',
+        'Artifacts: in 2.0 KB, out 5.0 MB',
+    ]
+    assert observer.format_metrics(None) == ''
+    # Fast actions may not have spent a whole second in any phase
+    assert observer.format_metrics({'phases': [('DOWNLOAD_SOURCE', 0.0), ('BUILD', 0.0)]}) == ''
+
+
+def test_promoted_releases_are_reported_without_tests(observer, monkeypatch):
+    sns = SNS()
+    monkeypatch.setattr(observer, 'sns_client', sns)
+    monkeypatch.setattr(observer, 'codebuild_client', Builds())
+    monkeypatch.setattr(observer, 'get_job_stages', lambda exec_id: [])
+    monkeypatch.setattr(observer, 'fetch_all_data', lambda pipeline, exec_id: {
+        'exec': {'pipelineExecution': {'artifactRevisions': [{'revisionId': 'abcdef1234'}]}},
+        'action_executions': {'actionExecutionDetails': []},
+    })
+    observer.send_report('YourApp_prod', 'e', 'SUCCEEDED')
+    assert sns.messages[0].startswith('SUCCEEDED: [abcdef12] Promoted release')
+    assert 'Not run: the release was tested before it was promoted.' in sns.messages[0]
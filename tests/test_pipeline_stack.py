@@ -0,0 +1,72 @@
+import pytest
+
+core = pytest.importorskip('aws_cdk.core')
+
+from pipeline.pipeline_stack import CDK_CLI, PipelineStack   # pylint: disable=wrong-import-position
+
+
+def synth(**kwargs):
+    app = core.App()
+    dev = PipelineStack(app, 'pipeline-dev', project_name='YourApp', stage='dev',
+                        git_repo='repo', git_branch='master', service_stacks=['app-dev'],
+                        promote_to='staging', approve_promotion=False)
+    stack = PipelineStack(app, 'pipeline-staging', project_name='YourApp', stage='staging',
+                          service_stacks=['app-staging'], promoted=True,
+                          release_bucket=dev.release_bucket, **kwargs)
+    assembly = app.synth()
+    return [assembly.get_stack_by_name(s.stack_name).template for s in [dev, stack]]
+
+
+def stages(template):
+    pipeline, = [r for r in template['Resources'].values()
+                 if r['Type'] == 'AWS::CodePipeline::Pipeline']
+    return {stage['Name']: stage['Actions'] for stage in pipeline['Properties']['Stages']}
+
+
+def buildspecs(template):
+    return [r['Properties']['Source']['BuildSpec'] for r in template['Resources'].values()
+            if r['Type'] == 'AWS::CodeBuild::Project']
+
+
+def test_pipelines_build_once_and_promote():
+    templates = synth(promote_to='prod', sns_emails=['someone@example.com'])
+    dev, staging = [stages(template) for template in templates]
+    assert list(dev) == ['Source', 'Install', 'TestAndBuild', 'DeployPipeline',
+                         'DeployWorkload', 'Promote']
+    assert list(staging) == ['Source', 'DeployPipeline', 'DeployWorkload', 'Promote']
+
+    package, promote = dev['Promote']
+    assert package['Name'] == 'Package'
+    assert [a['Name'] for a in package['InputArtifacts']] == [
+        dev['Install'][0]['OutputArtifacts'][0]['Name'], 'Build']
+    assert promote['Configuration']['ObjectKey'] == 'releases/staging/release.zip'
+
+    source, = staging['Source']
+    assert source['ActionTypeId']['Provider'] == 'S3'
+    assert source['Configuration']['S3ObjectKey'] == 'releases/staging/release.zip'
+    approve, promote = staging['Promote']
+    assert approve['ActionTypeId']['Category'] == 'Approval'
+    assert promote['RunOrder'] > approve['RunOrder']
+    assert promote['Configuration']['ObjectKey'] == 'releases/prod/release.zip'
+    assert 'NotificationArn' in approve['Configuration']
+
+    # Synthesis and deployments all use the CLI which ends up in the release
+    for template in templates:
+        for spec in buildspecs(template):
+            assert 'npm link' not in spec
+            assert ' cdk ' not in spec.replace(CDK_CLI, '')
+    assert any(f'{CDK_CLI} synth' in spec for spec in buildspecs(templates[0]))
+
+
+def test_promoted_pipeline_needs_the_release_bucket():
+    app = core.App()
+    with pytest.raises(ValueError):
+        PipelineStack(app, 'pipeline-prod', project_name='YourApp', stage='prod',
+                      service_stacks=['app-prod'], promoted=True)
+
+
+def test_pipeline_needs_a_repo_unless_promoted():
+    app = core.App()
+    with pytest.raises(ValueError):
+        PipelineStack(app, 'pipeline-dev', project_name='YourApp', stage='dev',
+                      service_stacks=['app-dev'])
@@ -0,0 +1,53 @@
+from ci import test_stage
+
+
+PASSING = """\
+tests/test_a.py ..
+==================== 2 passed, 1 warning in 0.10s ====================
+"""
+
+FAILING = """\
+tests/test_b.py F.s
+================ 1 failed, 1 passed, 1 skipped in 0.20s ================
+CoverageWarning: No data was collected.
+"""
+
+
+def test_shards_balance_by_size(tmp_path):
+    sizes = {'a.py': 900, 'b.py': 500, 'c.py': 400, 'd.py': 100}
+    for name, size in sizes.items():
+        (tmp_path / name).write_text('#' * size)
+    files = [str(tmp_path / name) for name in sizes]
+    shards = test_stage.shard(files, 2)
+    assert [[f[len(str(tmp_path)) + 1:] for f in s] for s in shards] == \
+        [['a.py', 'd.py'], ['b.py', 'c.py']]
+    assert len(test_stage.shard(files, 8)) == 4
+
+
+def test_outcome_counts_read_the_summary_line():
+    assert test_stage.outcome_counts(PASSING) == {'passed': 2, 'warnings': 1}
+    assert test_stage.outcome_counts(FAILING) == {'failed': 1, 'passed': 1, 'skipped': 1}
+    assert test_stage.outcome_counts('') == {}
+
+
+def test_combined_output_adds_up_the_workers():
+    result = test_stage.combine_test_output(
+        [['tests/test_a.py'], ['tests/test_b.py']], [PASSING, FAILING], 1.5)
+    assert 'worker 1: tests/test_a.py' in result
+    assert result.splitlines()[-1].strip('= ') == \
+        '1 failed, 3 passed, 1 skipped, 1 warnings in 1.50s across 2 workers'
+    assert test_stage.combine_test_output([['x']], [PASSING], 1.5) == PASSING
+
+
+def test_any_failing_worker_fails_the_tests():
+    assert test_stage.tests_status([0, 0]) == 0
+    assert test_stage.tests_status([0, 5]) == 0
+    assert test_stage.tests_status([0, 1, 5]) == 1
+    assert test_stage.tests_status([5, 5]) == 5
+
+
+def test_linter_and_tests_share_the_cores():
+    assert test_stage.split_cores(8) == (4, 4)
+    assert test_stage.split_cores(1) == (1, 1)
+    assert test_stage.split_cores(8, workers=6) == (2, 6)
+    assert test_stage.split_cores(8, lint=False) == (0, 8)